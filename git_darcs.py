@@ -1,18 +1,30 @@
 """Incremental import of git into darcs."""
 
+import ctypes
+import hashlib
+import json
 import os
+import re
+import select
+import signal
+import sqlite3
+import struct
 import sys
 import xml.etree.ElementTree as ET
-from collections import OrderedDict
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from contextlib import contextmanager
-from datetime import datetime
+from datetime import datetime, timezone
+from functools import lru_cache
+from heapq import heappop, heappush
 from pathlib import Path
 from shutil import copy, rmtree
 from subprocess import DEVNULL, PIPE, CalledProcessError
 from subprocess import Popen as SPOpen
 from subprocess import run as srun
-from threading import Thread
-from time import sleep
+from threading import Lock, Thread, get_ident
+from time import monotonic, sleep, time, time_ns
 
 import click
 from click import ClickException
@@ -21,8 +33,35 @@ from readchar import readkey
 from tqdm import tqdm
 
 _large = False
+_targeted = False
+_engine = "record"
+_strategy = "linearize"
+_verify = False
+_checkpoint_every = 100
+_squash_count = 0
+_squash_minutes = 0
+_squash_before = None
+_tree_mode = "040000"
+_exec_mode = "100755"
+_link_mode = "120000"
+_gitlink_mode = "160000"
+_max_record_paths = 1000
+_max_move_paths = 1000
+_maintenance = "due"
+# Patches since an optimize step last ran, before it is due again
+_maintenance_due = {"clean": 500, "compress": 200, "pristine": 2000}
+_prefetch = 8
+_prefetch_workers = 4
+# Bytes of prefetched blobs, before prefetching waits for the records
+_prefetch_bytes = 64 << 20
+_blobs = {}
+_blobs_size = 0
+_blobs_lock = Lock()
+# How git converts files on checkout, None until read
+_attributes = None
 _uuid = "_b531990e-3187-4b52-be1f-6e4d4d1e40c9"
 _darcs_comment = Path("_darcs", _uuid)
+_index_file = Path("_darcs", "git-darcs.sqlite")
 _env_comment = {"EDITOR": f"mv {_darcs_comment}", "VISUAL": f"mv {_darcs_comment}"}
 _isatty = sys.stdout.isatty()
 _verbose = False
@@ -30,6 +69,14 @@ _devnull = DEVNULL
 _disable = None
 _shutdown = False
 _darcs_date = "%Y%m%d%H%M%S"
+_meta = None
+_timings = None
+_trace = None
+_trace_start = 0.0
+_phases = set()
+_right = 1
+_left = 2
+_meta_format = "%H%x00%P%x00%ct%x00%cN <%cE>%x00%h %s"
 _pull_question = "Shall I pull this patch"
 _pull_help = """
 y: pull this patch
@@ -58,6 +105,17 @@ _boring = """
 
 _gitignore = "/_darcs"
 
+_darcs_author = re.compile(rb"^(.*)\*([*-])(\d{14})(?:\](.*))?$")
+_dot_node = re.compile(r'^\s*"([^"]+)"(?:\s*->\s*"([^"]+)")?')
+
+_in_modify = 0x2
+_in_moved_to = 0x80
+_in_create = 0x100
+_in_delete = 0x200
+_in_ignored = 0x8000
+_in_isdir = 0x40000000
+_inotify_mask = _in_modify | _in_moved_to | _in_create | _in_delete
+
 
 def handle_shutdown():
     """Wait for CTRL-D and set _shutdown, to flag a graceful shutdown request."""
@@ -65,10 +123,120 @@ def handle_shutdown():
     print("Use CTRL-D for a graceful shutdown.")
     sys.stdin.read()
     print("Shutting down, use CTRL-C if shutdown takes too long.")
-    print("If you use CTRL-C changes might be recorded twice.")
+    print("If you use CTRL-C the next update resumes after the last recorded commit.")
+    _shutdown = True
+
+
+def handle_signal(signum, frame):
+    """Set _shutdown on SIGTERM, to flag a graceful shutdown request."""
+    global _shutdown
     _shutdown = True
 
 
+@contextmanager
+def phase(name):
+    """Account the time spent in a phase, if timings or tracing are enabled."""
+    if (_timings is None and _trace is None) or name in _phases:
+        yield
+        return
+    _phases.add(name)
+    start = monotonic()
+    try:
+        yield
+    finally:
+        _phases.discard(name)
+        end = monotonic()
+        if _timings is not None:
+            entry = _timings["phases"].setdefault(name, {"count": 0, "seconds": 0.0})
+            entry["count"] += 1
+            entry["seconds"] += end - start
+        trace_span(name, "phase", start, end, {})
+
+
+def trace_span(name, cat, start, end, args):
+    """Add a complete event to the trace, if tracing is enabled."""
+    if _trace is not None:
+        _trace.append(
+            {
+                "name": name,
+                "cat": cat,
+                "ph": "X",
+                "ts": (start - _trace_start) * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": os.getpid(),
+                "tid": get_ident(),
+                "args": args,
+            }
+        )
+
+
+def trace_process(args, start, code, stdout):
+    """Add a span for a finished process to the trace."""
+    if _trace is None:
+        return
+    args = [str(x) for x in args]
+    name = " ".join([Path(args[0]).name] + args[1:2])
+    size = len(stdout) if isinstance(stdout, bytes) else None
+    trace_span(
+        name,
+        "process",
+        start,
+        monotonic(),
+        {"argv": args, "exit": code, "stdout": size},
+    )
+
+
+def start_trace(path):
+    """Start tracing all processes and phases, returns the function writing it."""
+    global _trace
+    global _trace_start
+    _trace = []
+    _trace_start = monotonic()
+    path = Path(path).absolute()
+
+    def write():
+        wall = monotonic() - _trace_start
+        with path.open("w", encoding="UTF-8") as f:
+            json.dump({"traceEvents": _trace, "displayTimeUnit": "ms"}, f)
+        summary = {}
+        for event in _trace:
+            key = (event["cat"], event["name"])
+            count, total, top = summary.get(key, (0, 0.0, 0.0))
+            seconds = event["dur"] / 1e6
+            summary[key] = (count + 1, total + seconds, max(top, seconds))
+        print(f"\nTrace written to {path}, {wall:.2f}s wall-time", file=sys.stderr)
+        print(
+            f"{'count':>8} {'total':>10} {'max':>9} {'wall':>6}  name", file=sys.stderr
+        )
+        rows = sorted(summary.items(), key=lambda x: x[1][1], reverse=True)
+        for (cat, name), (count, total, top) in rows[:30]:
+            share = 100 * total / wall if wall else 0
+            print(
+                f"{count:8} {total:9.2f}s {top:8.2f}s {share:5.1f}%  {cat}: {name}",
+                file=sys.stderr,
+            )
+
+    return write
+
+
+def start_timings():
+    """Start recording phase-timings, if GIT_DARCS_TIMINGS names a file."""
+    global _timings
+    path = os.environ.get("GIT_DARCS_TIMINGS")
+    if not path:
+        return None
+    _timings = {"command": sys.argv[1:], "start": monotonic(), "phases": {}}
+    path = Path(path).absolute()
+
+    def write():
+        timings = dict(_timings)
+        timings["seconds"] = monotonic() - timings.pop("start")
+        with path.open("w", encoding="UTF-8") as f:
+            json.dump(timings, f, indent=2)
+
+    return write
+
+
 def args_print(args):
     """Print args of executed command."""
     if _verbose:
@@ -87,8 +255,17 @@ class Popen(SPOpen):
             stderr = _devnull
         if not stdin and "input" not in kwargs:
             stdin = _devnull
+        self.started = monotonic()
         super().__init__(*args, stderr=stderr, stdin=stdin, **kwargs)
 
+    def wait(self, timeout=None):
+        """Wait for the process, trace it once it finished."""
+        code = super().wait(timeout=timeout)
+        if self.started is not None:
+            trace_process(self.args, self.started, code, None)
+            self.started = None
+        return code
+
 
 def run(*args, stdout=None, stderr=None, stdin=None, **kwargs):
     """Inject defaults into run."""
@@ -99,7 +276,127 @@ def run(*args, stdout=None, stderr=None, stdin=None, **kwargs):
         stderr = _devnull
     if not stdin and "input" not in kwargs:
         stdin = _devnull
-    return srun(*args, stdout=stdout, stderr=stderr, stdin=stdin, **kwargs)
+    start = monotonic()
+    try:
+        res = srun(*args, stdout=stdout, stderr=stderr, stdin=stdin, **kwargs)
+    except CalledProcessError as e:
+        trace_process(args[0], start, e.returncode, e.stdout)
+        raise
+    trace_process(args[0], start, res.returncode, res.stdout)
+    return res
+
+
+class CatFile:
+    """A long-lived `git cat-file --batch(-check)` process."""
+
+    def __init__(self, mode):
+        """Dear flake8 this is a init function."""
+        self.cmd = ["git", "cat-file", f"--{mode}"]
+        self.contents = mode == "batch"
+        self.proc = None
+        self.cwd = None
+        self.pid = os.getpid()
+        self.lock = Lock()
+
+    def query(self, obj):
+        """Get (sha, type, data) of an object, None if it is missing.
+
+        data is the size in batch-check mode.
+        """
+        if self.pid != os.getpid():
+            # In a forked worker the process and the lock belong to the parent
+            self.pid = os.getpid()
+            self.proc = None
+            self.lock = Lock()
+        with self.lock:
+            stat = os.stat(".")
+            cwd = (stat.st_dev, stat.st_ino)
+            if self.cwd != cwd:
+                self.stop()
+            if self.proc is None:
+                self.proc = Popen(self.cmd, stdin=PIPE, stdout=PIPE)
+                self.cwd = cwd
+            args_print(self.cmd + ["<<<", obj])
+            stdin = self.proc.stdin
+            stdout = self.proc.stdout
+            stdin.write(os.fsencode(obj) + b"\n")
+            stdin.flush()
+            header = stdout.readline()
+            if not header:
+                raise CalledProcessError(self.proc.wait(), self.cmd)
+            fields = header.decode("UTF-8", errors="replace").split()
+            if len(fields) != 3:
+                # <obj> missing, <obj> ambiguous
+                return None
+            sha, kind, size = fields
+            data = int(size)
+            if self.contents:
+                data = stdout.read(data)
+                stdout.read(1)
+            return sha, kind, data
+
+    def stop(self):
+        """Stop the process, expects the lock to be held."""
+        if self.proc is not None:
+            self.proc.stdin.close()
+            self.proc.wait()
+            self.proc = None
+
+    def close(self):
+        """Close the process."""
+        with self.lock:
+            self.stop()
+
+
+class GitSession:
+    """Keeps git helper-processes open for the whole command."""
+
+    def __init__(self):
+        """Dear flake8 this is a init function."""
+        self.batch = CatFile("batch")
+        self.check = CatFile("batch-check")
+
+    def resolve(self, obj):
+        """Get the hash of an object, None if it doesn't exist."""
+        res = self.check.query(obj)
+        if res is None:
+            return None
+        return res[0]
+
+    def size(self, obj):
+        """Get the size of an object."""
+        res = self.check.query(obj)
+        if res is None:
+            raise ValueError(f"git-object `{obj}` is missing")
+        return res[2]
+
+    def read(self, obj):
+        """Get the type and contents of an object."""
+        res = self.batch.query(obj)
+        if res is None:
+            raise ValueError(f"git-object `{obj}` is missing")
+        _, kind, data = res
+        return kind, data
+
+    def commit(self, rev):
+        """Get the headers and the message of a commit."""
+        kind, data = self.read(rev)
+        if kind != "commit":
+            raise ValueError(f"git-object `{rev}` is a {kind}")
+        head, _, message = data.partition(b"\n\n")
+        headers = {}
+        for line in head.decode("UTF-8", errors="replace").splitlines():
+            key, _, value = line.partition(" ")
+            headers.setdefault(key, []).append(value)
+        return headers, message.decode("UTF-8", errors="replace")
+
+    def close(self):
+        """Close all helper-processes."""
+        self.batch.close()
+        self.check.close()
+
+
+_git = GitSession()
 
 
 def hasnew():
@@ -116,34 +413,50 @@ def revert():
     run(["darcs", "revert", "--no-interactive"])
 
 
+def obliterate(count):
+    """Obliterate the last count darcs-patches."""
+    if count:
+        run(["darcs", "obliterate", f"--last={count}", "--all"], check=True)
+
+
 def initialize():
     """Initialize darcs."""
     run(["darcs", "initialize"], check=True)
 
 
-def relink():
+def relink(sibling=None):
     """Relink darcs-repo, this is a bit of cargo-cult."""
-    run(["darcs", "optimize", "relink"], check=True)
+    cmd = ["darcs", "optimize", "relink"]
+    if sibling:
+        cmd += [f"--sibling={sibling}"]
+    run(cmd, check=True)
+
 
+@phase("optimize")
+def optimize(step):
+    """Run one optimize-step on the darcs-repo."""
+    run(["darcs", "optimize", step], check=True)
 
-def optimize():
-    """Optimize darcs-repo, this is a bit of a cargo-cult."""
-    run(["darcs", "optimize", "clean"], check=True)
-    run(["darcs", "optimize", "compress"], check=True)
-    run(["darcs", "optimize", "pristine"], check=True)
 
+def is_tracked(path):
+    """Check if darcs can track a path of the working-tree."""
+    path = Path(path)
+    return (path.is_file() or path.is_dir()) and not path.is_symlink()
 
-def move(orig, new):
-    """Move a file in the darcs-repo."""
-    porig = Path(orig)
-    if (porig.is_file() or porig.is_dir()) and not porig.is_symlink():
-        dir = Path(new).parent
+
+@phase("move")
+def move(sources, target):
+    """Move a source to target, or many sources into the directory target."""
+    dir = Path(target)
+    if len(sources) == 1:
+        dir = dir.parent
+    if dir != Path("."):
         dir.mkdir(parents=True, exist_ok=True)
         darcs_add(dir)
-        run(
-            ["darcs", "move", "--case-ok", "--reserved-ok", orig, new],
-            check=True,
-        )
+    run(
+        ["darcs", "move", "--case-ok", "--reserved-ok"] + sources + [target],
+        check=True,
+    )
 
 
 def darcs_add(path):
@@ -159,6 +472,7 @@ def darcs_add(path):
             raise
 
 
+@phase("tag")
 def tag(name):
     """Tag a state in the darcs-repo."""
     run(
@@ -178,26 +492,96 @@ def get_tags():
     return res.stdout.decode("UTF-8").strip().splitlines()
 
 
-def darcs_clone(source, destination):
-    """Clone darcs-repo."""
-    run(
-        ["darcs", "clone", source, destination],
-        check=True,
-    )
+def darcs_clone(source, destination, *, working=True, patch=None):
+    """Clone darcs-repo, without working-tree if working is False.
+
+    If patch is set, only the patches up to the one with that hash are cloned.
+    """
+    cmd = ["darcs", "clone"]
+    if not working:
+        cmd += ["--no-working-dir"]
+    if patch:
+        cmd += ["--to-match", f"hash {patch}"]
+    run(cmd + [source, destination], check=True)
+
+
+def adopt_darcs(source, destination):
+    """Move the `_darcs` of a clone without working-tree into destination.
+
+    Destination has a working-tree, so darcs' `no-working-dir` flag is dropped.
+    """
+    darcs = Path(destination, "_darcs")
+    Path(source, "_darcs").rename(darcs)
+    fmt = Path(darcs, "format")
+    lines = fmt.read_text(encoding="UTF-8").splitlines(keepends=True)
+    lines = [x for x in lines if x.strip() != "no-working-dir"]
+    fmt.write_text("".join(lines), encoding="UTF-8")
 
 
 def get_patches(source, args):
-    """Get patches from darcs."""
-    res = run(
-        ["darcs", "pull", "--dry-run", "--xml-output"] + args + [source],
-        stdout=PIPE,
-        check=True,
-    )
-    res = res.stdout.decode("UTF-8").strip()
-    if res.startswith("No remote patches to pull in!"):
-        return ET.fromstring("<root></root>")
-    else:
-        return ET.fromstring(res)
+    """Get the patch-elements from darcs, parsed while darcs writes them.
+
+    Each element is dropped from the tree after it was yielded.
+    """
+    cmd = ["darcs", "pull", "--dry-run", "--xml-output", "--summary"] + args
+    cmd += [source]
+    parser = ET.XMLPullParser(["start", "end"])
+    root = None
+    depth = 0
+    with Popen(cmd, stdout=PIPE) as res:
+        while chunk := res.stdout.read(1 << 16):
+            if root is None and chunk.lstrip().startswith(b"No remote patches"):
+                res.stdout.read()
+                break
+            parser.feed(chunk)
+            for event, elem in parser.read_events():
+                if event == "start":
+                    depth += 1
+                    if root is None:
+                        root = elem
+                    continue
+                depth -= 1
+                if depth == 1 and elem.tag == "patch":
+                    yield elem
+                    root.remove(elem)
+        if res.wait():
+            raise CalledProcessError(res.returncode, cmd)
+    if root is not None:
+        parser.close()
+
+
+def get_dependencies(source, first):
+    """Get the direct dependencies of the patches in source from first on.
+
+    Returns None if unsupported. darcs names the nodes by a hash-prefix, `A -> B`
+    means A depends on B.
+    """
+    try:
+        res = run(
+            [
+                "darcs",
+                "show",
+                "dependencies",
+                "--repodir",
+                source,
+                "--from-match",
+                f"hash {first}",
+            ],
+            stdout=PIPE,
+            check=True,
+        )
+    except CalledProcessError:
+        return None
+    graph = {}
+    for line in res.stdout.decode("UTF-8", errors="replace").splitlines():
+        match = _dot_node.match(line)
+        if match:
+            node, depends = match.groups()
+            deps = graph.setdefault(node, [])
+            if depends:
+                deps.append(depends)
+                graph.setdefault(depends, [])
+    return graph
 
 
 def show_full_patch(source, patch):
@@ -211,6 +595,7 @@ def show_full_patch(source, patch):
     )
 
 
+@phase("pull")
 def pull_patch(source, hash):
     """Pull a darcs-patch."""
     run(
@@ -227,6 +612,29 @@ def pull_patch(source, hash):
     )
 
 
+def send_bundle(source, hashes, output):
+    """Write the darcs-bundle of patches from source we don't have yet."""
+    match = " || ".join(f"hash {x}" for x in hashes)
+    run(
+        [
+            "darcs",
+            "send",
+            "--repodir",
+            source,
+            "--all",
+            "--no-edit-description",
+            "--no-set-default",
+            "--output",
+            str(output.resolve()),
+            "--match",
+            match,
+            os.getcwd(),
+        ],
+        check=True,
+    )
+
+
+@phase("commit")
 def git_add(args=None):
     """Add changes to git."""
     if args is None:
@@ -235,16 +643,61 @@ def git_add(args=None):
         run(["git", "add"] + args, check=True)
 
 
+@phase("commit")
+def git_stage(paths):
+    """Stage only paths in git, removed ones included."""
+    existing = [x for x in paths if os.path.lexists(x)]
+    missing = [x for x in paths if not os.path.lexists(x)]
+    if existing:
+        # Like `git add .` skip new files that are ignored
+        res = run(
+            ["git", "check-ignore", "-z", "--stdin"],
+            input=b"\0".join(os.fsencode(x) for x in existing),
+            stdout=PIPE,
+        )
+        ignored = {os.fsdecode(x) for x in res.stdout.split(b"\0")}
+        existing = [x for x in existing if x not in ignored]
+    for cmd, paths in (
+        (["add", "-A"], existing),
+        (["rm", "--cached", "-r", "-q", "--ignore-unmatch"], missing),
+    ):
+        if paths:
+            run(
+                ["git", "--literal-pathspecs"]
+                + cmd
+                + ["--pathspec-from-file=-", "--pathspec-file-nul"],
+                input=b"\0".join(os.fsencode(x) for x in paths),
+                check=True,
+            )
+
+
+@phase("commit")
 def git_commit(message):
     """Git commit."""
     run(["git", "commit", "--allow-empty", "-m", message], check=True)
 
 
 def git_clone(source, destination):
-    """Clone git-repo."""
-    run(["git", "clone", source, destination], check=True)
-
-
+    """Clone git-repo, hardlinking the objects."""
+    run(["git", "clone", "--local", source, destination], check=True)
+
+
+def get_link_stats(*paths):
+    """Get the bytes (copied, linked) of the files in paths."""
+    copied = 0
+    linked = 0
+    for path in paths:
+        for dir, _, files in os.walk(path):
+            for name in files:
+                stat = os.lstat(os.path.join(dir, name))
+                if stat.st_nlink > 1:
+                    linked += stat.st_size
+                else:
+                    copied += stat.st_size
+    return copied, linked
+
+
+@phase("wipe")
 def wipe():
     """Completely clean the git-repo except `_darcs`."""
     run(
@@ -257,28 +710,15 @@ def wipe():
     )
 
 
+@phase("checkout")
 def checkout(rev):
     """Checkout a git-commit."""
-    if _large:
-        sleep(0.01)  # Make sure timestamps differ
     run(
         ["git", "checkout", rev],
         check=True,
     )
 
 
-def is_ancestor(rev, last):
-    """Check if revisiion can fast-forward."""
-    # I don't know why git thinks revs are their own ancestor
-    if rev == last:
-        return False
-    try:
-        run(["git", "merge-base", "--is-ancestor", last, rev], check=True)
-        return True
-    except CalledProcessError:
-        return False
-
-
 def get_current_branch():
     """Get the current branch from git."""
     res = run(
@@ -292,21 +732,194 @@ def get_current_branch():
     return branch
 
 
+class CommitMeta:
+    """Metadata (author, oneline, parents) of the commits from base to head."""
+
+    def __init__(self, base):
+        """Dear flake8 this is a init function."""
+        self.base = base
+        self.index = {}
+        self.parents = []
+        self.generation = []
+        self.date = []
+        self.author = []
+        self.oneline = []
+        self.merges = set()
+        self.descendants = set()
+        self.authors = {}
+
+    def __len__(self):
+        """Get the count of commits with metadata."""
+        return len(self.parents)
+
+    def add(self, rev, parents, date, author, oneline):
+        """Add a commit, its parents have to be added first."""
+        index = self.index
+        current = len(self.parents)
+        if len(parents) > 1:
+            self.merges.add(current)
+        descendants = self.descendants
+        for parent in parents:
+            if parent == self.base or index.get(parent) in descendants:
+                descendants.add(current)
+                break
+        parents = tuple(index[x] for x in parents if x in index)
+        generation = 1 + max((self.generation[x] for x in parents), default=0)
+        index[rev] = current
+        self.parents.append(parents)
+        self.generation.append(generation)
+        self.date.append(date)
+        self.author.append(self.authors.setdefault(author, author))
+        self.oneline.append(oneline)
+
+    def get_author(self, rev):
+        """Get the author of a commit, None if unknown."""
+        index = self.index.get(rev)
+        if index is None:
+            return None
+        return self.author[index]
+
+    def get_date(self, rev):
+        """Get the committer-date of a commit, None if unknown."""
+        index = self.index.get(rev)
+        if index is None:
+            return None
+        return self.date[index]
+
+    def get_onelines(self, rev, *, last=None, merges=False):
+        """Get the short-messages like `git log --oneline`, None if unknown."""
+        start = self.index.get(rev)
+        if start is None:
+            return None
+        if not last:
+            return [self.oneline[start]]
+        if last == self.base:
+            stop = None
+        else:
+            # Only ranges starting on the linearized path are complete
+            stop = self.index.get(last)
+            if stop not in self.descendants:
+                return None
+        res = self.date_order(self.range(start, stop))
+        if merges:
+            res = [x for x in res if x not in self.merges]
+        return [self.oneline[x] for x in res]
+
+    def range(self, start, stop):
+        """Get the commits reachable from start, but not from stop (`stop..start`)."""
+        # Paint down both sides in generation order, like git's merge-base
+        flags = {}
+        queue = []
+        right = 0
+        paint = [(start, _right)]
+        if stop is not None:
+            paint.append((stop, _left))
+        res = []
+        while paint or right:
+            for commit, flag in paint:
+                old = flags.get(commit)
+                if old is None:
+                    flags[commit] = flag
+                    heappush(queue, (-self.generation[commit], commit))
+                    if flag == _right:
+                        right += 1
+                elif old | flag != old:
+                    flags[commit] = old | flag
+                    if old == _right:
+                        right -= 1
+            if not right:
+                break
+            _, commit = heappop(queue)
+            flag = flags[commit]
+            if flag == _right:
+                right -= 1
+                res.append(commit)
+            paint = [(x, flag) for x in self.parents[commit]]
+        return res
+
+    def date_order(self, commits):
+        """Sort commits like `git log --date-order`."""
+        indegree = dict.fromkeys(commits, 0)
+        for commit in commits:
+            for parent in self.parents[commit]:
+                if parent in indegree:
+                    indegree[parent] += 1
+        count = 0
+        queue = []
+        for commit in commits:
+            if indegree[commit] == 0:
+                heappush(queue, (-self.date[commit], count, commit))
+                count += 1
+        res = []
+        while queue:
+            _, _, commit = heappop(queue)
+            res.append(commit)
+            for parent in self.parents[commit]:
+                if parent in indegree:
+                    indegree[parent] -= 1
+                    if indegree[parent] == 0:
+                        heappush(queue, (-self.date[parent], count, parent))
+                        count += 1
+        return res
+
+
+def get_commit_meta(head, base):
+    """Load the metadata of all commits from base to head with one `git log`."""
+    meta = CommitMeta(base)
+    with Popen(
+        [
+            "git",
+            "log",
+            "--reverse",
+            "--topo-order",
+            "--no-decorate",
+            f"--format={_meta_format}",
+            f"{base}..{head}",
+        ],
+        stdout=PIPE,
+    ) as res:
+        while line := res.stdout.readline():
+            rev, parents, date, by, oneline = (
+                line.decode("UTF-8").rstrip("\n").split("\x00")
+            )
+            meta.add(rev, parents.split(), int(date), by, oneline)
+    if _verbose:
+        print(f"{len(meta)} commits in metadata")
+    return meta
+
+
 def author(rev):
     """Get the author of a commit from git."""
-    res = run(
-        ["git", "log", "--pretty=format:%cN <%cE>", "--max-count=1", rev],
-        stdout=PIPE,
-        check=True,
-    )
-    msg = res.stdout.decode("UTF-8").strip()
+    msg = _meta and _meta.get_author(rev)
+    if msg is None:
+        res = run(
+            ["git", "log", "--pretty=format:%cN <%cE>", "--max-count=1", rev],
+            stdout=PIPE,
+            check=True,
+        )
+        msg = res.stdout.decode("UTF-8").strip()
     if _verbose:
         print(msg)
     return msg
 
 
+def commit_date(rev):
+    """Get the committer-date of a commit in darcs' format."""
+    date = _meta and _meta.get_date(rev)
+    if date is None:
+        headers, _ = _git.commit(rev)
+        date = int(headers["committer"][0].split()[-2])
+    return datetime.fromtimestamp(date, timezone.utc).strftime(_darcs_date)
+
+
 def onelines(rev, *, last=None, merges=False):
     """Get the short-message of a commit from git."""
+    msgs = _meta and _meta.get_onelines(rev, last=last, merges=merges)
+    if msgs is not None:
+        msg = "\n".join(msgs).strip()
+        if _verbose:
+            print(msg)
+        return msg.splitlines()
     if last:
         cmd = [
             "git",
@@ -331,27 +944,49 @@ def onelines(rev, *, last=None, merges=False):
     return msg.splitlines()
 
 
+def rev_parse(rev):
+    """Get the hash of a commit-ish from git."""
+    sha = _git.resolve(f"{rev}^{{commit}}")
+    if sha is None:
+        raise ClickException(f"Unknown revision `{rev}`")
+    return sha
+
+
 def get_head():
     """Get the current head from git."""
-    res = run(
-        ["git", "rev-parse", "HEAD"],
-        check=True,
-        stdout=PIPE,
-    )
-    head = res.stdout.strip().decode("UTF-8")
+    head = _git.resolve("HEAD")
+    if head is None:
+        raise ClickException("HEAD does not point to a commit.")
     if _verbose:
         print(head)
     return head
 
 
-def record_all(rev, *, last=None, postfix=None, comments=None):
-    """Record all change onto the darcs-repo."""
-    assert rev != last
+def get_message(rev, *, last=None):
+    """Get the name and the comment-lines of the darcs-patch for a commit."""
     msgs = onelines(rev, last=last, merges=False)
     if not msgs:
         msgs = onelines(rev, last=last, merges=True)
-    msg = msgs[0]
-    comments = "\n".join(msgs[1:])
+    return msgs[0], msgs[1:]
+
+
+@phase("record")
+def record_all(
+    rev, *, last=None, postfix=None, comments=None, paths=None, ignore_times=True
+):
+    """Record all change onto the darcs-repo, or only the changes in paths.
+
+    Unless ignore_times is set, darcs trusts the mtimes of the working-tree.
+    """
+    assert rev != last
+    if paths is not None:
+        if not paths:
+            return
+        paths = [f"./{x}" for x in paths]
+    else:
+        paths = []
+    msg, comments = get_message(rev, last=last)
+    comments = "\n".join(comments)
     by = author(rev)
     if postfix:
         msg = f"{msg} {postfix}"
@@ -359,13 +994,13 @@ def record_all(rev, *, last=None, postfix=None, comments=None):
         msg = f"{msg}\n\n{comments}"
     with _darcs_comment.open("w", encoding="UTF-8") as f:
         f.write(msg)
+    _index.recording(rev, final=not postfix)
     try:
         env = dict(os.environ)
         env.update(_env_comment)
-        if _large:
-            ignore_times = []
-        else:
-            ignore_times = ["--ignore-times"]
+        times = []
+        if ignore_times:
+            times = ["--ignore-times"]
         res = run(
             [
                 "darcs",
@@ -373,23 +1008,26 @@ def record_all(rev, *, last=None, postfix=None, comments=None):
                 "--look-for-adds",
                 "--no-interactive",
             ]
-            + ignore_times
+            + times
             + [
                 "--edit-long-comment",
                 "--author",
                 by,
                 "--name",
                 "",
-            ],
+            ]
+            + paths,
             check=True,
             stdout=PIPE,
             env=env,
         )
         if _verbose:
             print(res.stdout.decode("UTF-8").strip())
+        _index.recorded(rev)
     except CalledProcessError as e:
         if "No changes!" not in e.stdout.decode("UTF-8"):
             raise
+        _index.recorded(rev, patches=0)
 
 
 def get_rev_list_cmd(head, base, merges=False):
@@ -407,21 +1045,117 @@ def get_rev_list_cmd(head, base, merges=False):
     return cmd
 
 
-def get_rev_list(head, base):
-    """Get a linearized path from base to head from git."""
-    with Popen(
-        get_rev_list_cmd(head, base, merges=False),
-        stdout=PIPE,
-    ) as res:
+class CommitGraph:
+    """In-memory ancestry-index of the linearized path from base to head."""
+
+    def __init__(self, base):
+        """Dear flake8 this is a init function."""
+        self.base = base
+        self.width = 0
+        self.shas = bytearray()
+        self.index = {}
+        self.parents = array("L")
+        self.offsets = array("L", [0])
+        self.generation = array("L")
+        self.merges = set()
+
+    def __len__(self):
+        """Get the count of commits in the graph."""
+        return len(self.generation)
+
+    def rev(self, index):
+        """Get the hash of the commit at index."""
+        start = index * self.width
+        end = start + self.width
+        return self.shas[start:end].hex()
+
+    def get_parents(self, index):
+        """Get the indexes of the parents that are part of the graph."""
+        start = self.offsets[index]
+        end = self.offsets[index + 1]
+        return self.parents[start:end]
+
+    def add(self, rev, parents):
+        """Add a commit, its parents have to be added first."""
+        sha = bytes.fromhex(rev)
+        self.width = len(sha)
+        index = self.index
+        current = len(self)
+        if len(parents) > 1:
+            self.merges.add(current)
+        generation = 0
+        for parent in parents:
+            parent = index.get(bytes.fromhex(parent))
+            if parent is not None:
+                self.parents.append(parent)
+                generation = max(generation, self.generation[parent])
+        self.offsets.append(len(self.parents))
+        self.generation.append(generation + 1)
+        self.shas += sha
+        index[sha] = current
+
+    def linearized(self):
+        """Get the revisions the linearization visits, in order.
+
+        First the revisions without merges, then all revisions.
+        """
+        count = len(self)
+        for index in range(count):
+            if index not in self.merges:
+                yield self.rev(index)
+        for index in range(count):
+            yield self.rev(index)
+
+    def is_ancestor(self, rev, last):
+        """Check if revision can fast-forward."""
+        # I don't know why git thinks revs are their own ancestor
+        if rev == last:
+            return False
+        index = self.index
+        start = index.get(bytes.fromhex(rev))
+        if start is None:
+            return False
+        # Every commit on the ancestry-path is a descendant of base
+        if last == self.base:
+            return True
+        target = index.get(bytes.fromhex(last))
+        if target is None:
+            return False
+        # Commits with a lower or equal generation can't descend from last
+        generation = self.generation[target]
+        stack = [start]
+        seen = {start}
+        while stack:
+            for parent in self.get_parents(stack.pop()):
+                if parent == target:
+                    return True
+                if parent not in seen and self.generation[parent] > generation:
+                    seen.add(parent)
+                    stack.append(parent)
+        return False
+
+
+def get_commit_graph(head, base):
+    """Load the ancestry-graph of the linearized path from git, in one pass."""
+    graph = CommitGraph(base)
+    cmd = get_rev_list_cmd(head, base, merges=True)
+    with Popen(cmd[:2] + ["--parents"] + cmd[2:], stdout=PIPE) as res:
         while line := res.stdout.readline():
-            yield line.decode("UTF-8").strip()
-        else:
-            with Popen(
-                get_rev_list_cmd(head, base, merges=True),
-                stdout=PIPE,
-            ) as res:
-                while line := res.stdout.readline():
-                    yield line.decode("UTF-8").strip()
+            rev, *parents = line.decode("UTF-8").split()
+            graph.add(rev, parents)
+    if _verbose:
+        print(f"{len(graph)} commits in graph")
+    return graph
+
+
+def get_merge_base(revs):
+    """Get the best common ancestor of revs from git."""
+    res = run(
+        ["git", "merge-base", "--octopus"] + list(revs),
+        stdout=PIPE,
+        check=True,
+    )
+    return res.stdout.decode("UTF-8").strip()
 
 
 def get_base():
@@ -441,79 +1175,696 @@ def get_base():
     return base
 
 
-class RenameDiffState:
-    """State-machine for the rename parser."""
+def get_diff_tree(rev, *, last=None, args=()):
+    """Get the NUL-delimited fields of `git diff-tree -z` for a commit."""
+    assert last != rev
+    cmd = ["git", "diff-tree", "-r", "-z", "--no-commit-id"] + list(args)
+    if last is None:
+        cmd += [rev]
+    else:
+        cmd += [last, rev]
+    res = run(cmd, stdout=PIPE, check=True)
+    fields = res.stdout.split(b"\0")
+    if fields[-1] == b"":
+        fields.pop()
+    return fields
+
 
-    INIT = 1
-    IN_DIFF = 2
-    ORIG_FOUND = 3
+@lru_cache(maxsize=64)
+def get_changes(rev, *, last=None):
+    """Get the changes of a commit from git, including directories and renames.
 
+    Each change is a tuple (status, old_mode, new_mode, sha, path, orig), orig is the
+    source of a rename. Paths may contain any byte.
+    """
+    fields = get_diff_tree(rev, last=last, args=["-t", "-M"])
+    changes = []
+    pos = 0
+    while pos < len(fields):
+        old_mode, new_mode, _, sha, status = fields[pos][1:].decode("ASCII").split()
+        status = status[0]
+        if status in "RC":
+            orig = os.fsdecode(fields[pos + 1])
+            path = os.fsdecode(fields[pos + 2])
+            pos += 3
+        else:
+            orig = None
+            path = os.fsdecode(fields[pos + 1])
+            pos += 2
+        changes.append((status, old_mode, new_mode, sha, path, orig))
+    return tuple(changes)
 
-def get_rename_diff(rev, *, last=None):
-    """Request the renames of a commit from git."""
-    assert last != rev
+
+def in_dirs(path, dirs):
+    """Check if path is inside one of dirs."""
+    parent, _, _ = path.rpartition("/")
+    while parent:
+        if parent in dirs:
+            return True
+        parent, _, _ = parent.rpartition("/")
+    return False
+
+
+def count_files(rev, dir):
+    """Count the files in a directory of a commit, subdirectories included."""
+    res = run(
+        ["git", "ls-tree", "-r", "-z", "--name-only", rev, "--", dir],
+        stdout=PIPE,
+        check=True,
+    )
+    return res.stdout.count(b"\0")
+
+
+def get_moves(rev, *, last=None):
+    """Get the directory-moves and the remaining renames of a commit.
+
+    A directory git removed, whose files all moved to the same new directory, is
+    moved as a whole.
+    """
+    removed = set()
+    added = set()
+    deleted = []
+    renames = []
+    for status, old_mode, new_mode, _, path, orig in get_changes(rev, last=last):
+        if status == "D" and old_mode == _tree_mode:
+            removed.add(path)
+        elif status == "D":
+            deleted.append(path)
+        elif status == "A" and new_mode == _tree_mode:
+            added.add(path)
+        elif status == "R" and old_mode == _tree_mode:
+            # Unchanged trees are detected as renames
+            removed.add(orig)
+            added.add(path)
+        elif status == "R":
+            renames.append((orig, path))
+    targets = {}
+    for orig, new in renames:
+        parts = orig.split("/")
+        for pos in range(1, len(parts)):
+            rest = "/".join(parts[pos:])
+            end = len(new) - len(rest) - 1
+            target = None
+            if new.endswith(f"/{rest}"):
+                target = new[:end]
+            targets.setdefault("/".join(parts[:pos]), set()).add(target)
+    dirs = {}
+    for dir in sorted(removed, key=lambda x: x.count("/")):
+        if in_dirs(dir, dirs):
+            continue
+        target = targets.get(dir, ())
+        if len(target) != 1:
+            continue
+        (new,) = target
+        prefix = f"{dir}/"
+        if new not in added or any(x.startswith(prefix) for x in deleted):
+            continue
+        # A file that isn't moved along would end up in the new directory
+        moved = sum(1 for orig, _ in renames if orig.startswith(prefix))
+        if moved == count_files(last or f"{rev}^", dir):
+            dirs[dir] = new
+    renames = [(orig, new) for orig, new in renames if not in_dirs(orig, dirs)]
+    return sorted(dirs.items(), key=lambda x: x[1]), renames
+
+
+def group_moves(renames):
+    """Group renames into (sources, target) moves, batched by target-directory."""
+    batches = {}
+    for orig, new in renames:
+        if not is_tracked(orig):
+            continue
+        dir, _, name = new.rpartition("/")
+        if name == orig.rpartition("/")[2]:
+            batches.setdefault(dir or ".", []).append((orig, new))
+        else:
+            yield [orig], new
+    for dir, moves in batches.items():
+        for pos in range(0, len(moves), _max_move_paths):
+            end = pos + _max_move_paths
+            batch = moves[pos:end]
+            if len(batch) == 1:
+                yield [batch[0][0]], batch[0][1]
+            else:
+                yield [orig for orig, _ in batch], dir
+
+
+def record_moves(rev, dirs, renames, pbar):
+    """Move in darcs, record the pending moves only if darcs refuses a move."""
+    count = 0
+
+    def apply(sources, target):
+        nonlocal count
+        try:
+            move(sources, target)
+        except CalledProcessError:
+            record_all(rev, postfix=f"move({count:03d})")
+            count += 1
+            move(sources, target)
+
+    for orig, new in dirs:
+        if is_tracked(orig):
+            apply([orig], new)
+        pbar.update()
+    # Chained renames need their target moved away first, cycles stay changes
+    while renames:
+        ready = [x for x in renames if not os.path.lexists(x[1])]
+        if not ready:
+            break
+        renames = [x for x in renames if os.path.lexists(x[1])]
+        for sources, target in group_moves(ready):
+            apply(sources, target)
+        pbar.update(len(ready))
+
+
+def get_record_paths(rev, *, last=None):
+    """Get the paths darcs has to look at to record a commit, None for all."""
     if last is None:
-        action = "show"
-        range = rev
+        return None
+    paths = []
+    for status, _, new_mode, _, path, orig in get_changes(rev, last=last):
+        # Directories are listed when files inside change, only adds/removes matter
+        if status == "M" and new_mode == _tree_mode:
+            continue
+        if orig:
+            paths.append(orig)
+        paths.append(path)
+    if len(paths) > _max_record_paths:
+        return None
+    return paths
+
+
+def cat_blobs(shas):
+    """Read blobs from the git-session."""
+    blobs = {}
+    for sha in shas:
+        _, blobs[sha] = _git.read(sha)
+    return blobs
+
+
+def changed_blobs(rev, *, last=None):
+    """Get the blobs git added or changed in a commit."""
+    return {
+        sha
+        for status, _, mode, sha, _, _ in get_changes(rev, last=last)
+        if status != "D" and mode not in (_tree_mode, _gitlink_mode)
+    }
+
+
+def pop_blobs(rev, *, last=None):
+    """Remove the prefetched blobs of a commit, None if they aren't loaded."""
+    global _blobs_size
+    with _blobs_lock:
+        blobs, size = _blobs.pop((rev, last), (None, 0))
+        _blobs_size -= size
+    return blobs
+
+
+def get_blobs(rev, *, last=None):
+    """Get the blobs git added or changed in a commit, prefetched ones are evicted."""
+    blobs = pop_blobs(rev, last=last)
+    if blobs is None:
+        blobs = cat_blobs(changed_blobs(rev, last=last))
+    return blobs
+
+
+def clear_blobs():
+    """Drop the prefetched blobs."""
+    global _blobs_size
+    with _blobs_lock:
+        _blobs.clear()
+        _blobs_size = 0
+
+
+def remove_path(path):
+    """Remove a file or directory from the working-tree."""
+    if path.is_symlink() or path.is_file():
+        path.unlink()
+    elif path.is_dir():
+        rmtree(path)
+
+
+def write_path(path, mode, data, umask):
+    """Write a git-object to the working-tree."""
+    if path.is_symlink() or path.exists():
+        remove_path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if mode == _gitlink_mode:
+        path.mkdir()
+    elif mode == _link_mode:
+        os.symlink(os.fsdecode(data), path)
     else:
-        action = "diff"
-        range = f"{last}..{rev}"
-    with Popen(
-        ["git", action, "--diff-filter=R", range],
+        with path.open("wb") as f:
+            f.write(data)
+        if mode == _exec_mode:
+            path.chmod(0o777 & ~umask)
+
+
+def next_stamp(path):
+    """Get an mtime in nanoseconds for rewriting path, newer than its current one.
+
+    At least the next second, in case darcs compares whole seconds.
+    """
+    now = time_ns()
+    try:
+        mtime = os.lstat(path).st_mtime_ns
+    except FileNotFoundError:
+        return now
+    return max(now, (mtime // 10**9 + 1) * 10**9)
+
+
+def get_converted(paths, *, reread=False):
+    """Get the paths git converts on checkout, by attributes or core.autocrlf.
+
+    Attributes are read from the index, reread them if a `.gitattributes` changed.
+    """
+    global _attributes
+    if _attributes is None or reread:
+        config = []
+        for name in ("core.autocrlf", "core.eol"):
+            res = run(["git", "config", name], stdout=PIPE)
+            config.append(res.stdout.decode("UTF-8").strip().lower())
+        res = run(
+            ["git", "ls-files", "-z", "--", ":(glob)**/.gitattributes"],
+            stdout=PIPE,
+            check=True,
+        )
+        found = bool(res.stdout)
+        if not found:
+            res = run(
+                ["git", "rev-parse", "--git-path", "info/attributes"],
+                stdout=PIPE,
+                check=True,
+            )
+            found = Path(os.fsdecode(res.stdout.strip())).exists()
+        _attributes = (config[0] == "true", config[1] == "crlf", found)
+    autocrlf, crlf, found = _attributes
+    if autocrlf:
+        return set(paths)
+    if not found or not paths:
+        return set()
+    res = run(
+        ["git", "check-attr", "--cached", "-z", "--stdin"]
+        + ["filter", "ident", "working-tree-encoding", "eol", "text"],
+        input=b"\0".join(os.fsencode(x) for x in paths),
         stdout=PIPE,
-    ) as res:
-        while line := res.stdout.readline():
-            yield line.decode("UTF-8").strip()
-
-
-def get_renames(rev, *, last=None):
-    """Parse the renames from a git-rename-diff."""
-    s = RenameDiffState
-    state = s.INIT
-    orig = ""
-    new = ""
-    for line in get_rename_diff(rev, last=last):
-        if state == s.INIT:
-            if line.startswith("diff --git"):
-                state = s.IN_DIFF
-        elif state == s.IN_DIFF:
-            start = "rename from "
-            if line.startswith(start):
-                _, _, orig = line.partition(start)
-                orig = orig.strip()
-                state = s.ORIG_FOUND
-        elif state == s.ORIG_FOUND:
-            start = "rename to "
-            if line.startswith(start):
-                _, _, new = line.partition(start)
-                yield (orig, new)
-                state = s.IN_DIFF
-
-
-def record_revision(rev, *, last=None):
-    """Record a revision, pre-record moves if there are any."""
-    iters = 0
-    count = 0
-    renames = 0
-    for _ in get_renames(rev, last=last):
-        renames += 1
-
-    if renames:
-        with tqdm(desc="moves", total=renames, leave=False, disable=_disable) as pbar:
-            for orig, new in get_renames(rev, last=last):
-                move(orig, new)
-                iters += 1
-                if iters % 50 == 0:
-                    record_all(rev, postfix=f"move({count:03d})")
-                    count += 1
-                pbar.update()
+        check=True,
+    )
+    fields = res.stdout.split(b"\0")
+    converted = set()
+    for pos in range(0, len(fields) - 2, 3):
+        end = pos + 3
+        path, attr, value = fields[pos:end]
+        if attr in (b"filter", b"working-tree-encoding"):
+            convert = value not in (b"unspecified", b"unset")
+        elif attr == b"ident":
+            convert = value == b"set"
+        elif attr == b"eol":
+            convert = value == b"crlf"
+        else:
+            convert = crlf and value in (b"set", b"auto")
+        if convert:
+            converted.add(os.fsdecode(path))
+    return converted
+
+
+def materialize(rev, *, last):
+    """Move the working-tree from last to rev, only touching the changed paths."""
+    removed = []
+    written = []
+    for status, _, new_mode, sha, path, orig in get_changes(rev, last=last):
+        if status == "R":
+            removed.append(orig)
+        if status == "D":
+            removed.append(path)
+        elif new_mode != _tree_mode:
+            written.append((path, new_mode, sha))
+    # Deepest paths first, so files go before their directories
+    for path in sorted(removed, key=lambda x: x.count("/"), reverse=True):
+        remove_path(Path(path))
+    blobs = get_blobs(rev, last=last)
+    umask = os.umask(0)
+    os.umask(umask)
+    files = [x for x, mode, _ in written if is_file(mode)]
+    stamps = {}
+    if _large:
+        stamps = {x: next_stamp(x) for x in files}
+    set_head(rev)
+    # Filters and eol-conversions only apply when git writes the files
+    reread = any(x.rpartition("/")[2] == ".gitattributes" for x in removed + files)
+    converted = get_converted(files, reread=reread)
+    for path, mode, sha in written:
+        if path not in converted:
+            write_path(Path(path), mode, blobs.get(sha), umask)
+    if converted:
+        run(
+            ["git", "checkout-index", "-f", "-u", "-z", "--stdin"],
+            input=b"\0".join(os.fsencode(x) for x in converted),
+            check=True,
+        )
+    for path, stamp in stamps.items():
+        os.utime(path, ns=(stamp, stamp))
+
+
+def set_head(rev):
+    """Point HEAD and the index at rev, without touching the working-tree."""
+    run(["git", "update-ref", "--no-deref", "HEAD", rev], check=True)
+    # Keeps the stat-info of unchanged entries, so git doesn't rehash the tree
+    run(["git", "read-tree", "--reset", rev], check=True)
+
+
+@phase("checkout")
+def update_tree(rev, *, last=None, moved=False):
+    """Update the working-tree to rev, wipe and checkout if that fails.
+
+    Returns True if only the changed paths were written.
+    """
+    if last is not None:
+        try:
+            materialize(rev, last=last)
+            return True
+        except (OSError, ValueError, CalledProcessError) as e:
+            print(f"Repairing working-tree after: {e}")
+        run(["git", "checkout", "--force", rev], check=True)
+        wipe()
+        return False
+    if moved:
         wipe()
     checkout(rev)
-    record_all(rev, last=last)
+    return False
+
+
+@phase("revision")
+def record_revision(rev, *, last=None, targeted=False):
+    """Record a revision, pre-record moves if there are any.
+
+    If targeted is set only the paths git changed are recorded.
+    """
+    dirs, renames = get_moves(rev, last=last)
+    moved = bool(dirs or renames)
+    if moved:
+        total = len(dirs) + len(renames)
+        with tqdm(desc="moves", total=total, leave=False, disable=_disable) as pbar:
+            record_moves(rev, dirs, renames, pbar)
+    # Materialize gives the files it writes fresh mtimes in large mode
+    stamped = update_tree(rev, last=last, moved=moved) and _large
+    paths = None
+    if targeted:
+        paths = get_record_paths(rev, last=last)
+    record_all(rev, last=last, paths=paths, ignore_times=not stamped)
+
+
+def get_last_patches(count):
+    """Get the hashes of the last count darcs-patches, oldest first."""
+    res = run(
+        ["darcs", "log", f"--last={count}", "--xml-output"],
+        stdout=PIPE,
+        check=True,
+    )
+    xml = ET.fromstring(res.stdout.decode("UTF-8"))
+    return [x.attrib["hash"] for x in reversed(xml.findall("patch"))]
+
+
+class PatchIndex:
+    """Maps darcs-patches to the git-commits they belong to, stored in `_darcs`."""
+
+    def __init__(self):
+        """Dear flake8 this is a init function."""
+        self.db = None
+        self.pending = []
+        self.count = 0
+        self.journal = False
+        self.last_done = None
+
+    def open(self):
+        """Open the database, create it if needed."""
+        if self.db is None:
+            db = sqlite3.connect(_index_file)
+            with db:
+                db.executescript("""
+                    CREATE TABLE IF NOT EXISTS patches (
+                        hash TEXT PRIMARY KEY,
+                        rev TEXT NOT NULL,
+                        kind TEXT NOT NULL
+                    );
+                    CREATE INDEX IF NOT EXISTS patches_rev ON patches (rev);
+                    CREATE TABLE IF NOT EXISTS maintenance (
+                        step TEXT NOT NULL,
+                        started REAL NOT NULL,
+                        seconds REAL NOT NULL,
+                        patches INTEGER NOT NULL,
+                        inventory INTEGER NOT NULL,
+                        pristine INTEGER NOT NULL
+                    );
+                    CREATE TABLE IF NOT EXISTS journal (
+                        state TEXT NOT NULL,
+                        rev TEXT NOT NULL,
+                        hash TEXT,
+                        patches INTEGER NOT NULL
+                    );
+                    """)
+            self.db = db
+        return self.db
+
+    def add(self, rev, *, kind="record", count=1):
+        """Note that count darcs-patches were created for rev.
+
+        Their hashes are read from darcs when flushing.
+        """
+        self.count += count
+        self.pending.append((rev, kind, self.count))
+
+    def flush(self):
+        """Write the pending patches in one transaction."""
+        if not self.count:
+            return
+        hashes = get_last_patches(self.count)
+        pending = self.pending
+        self.pending = []
+        self.count, count = 0, self.count
+        # Someone else changed darcs, better no mapping than a wrong one
+        if len(hashes) != count:
+            return
+        rows = [(hashes[pos - 1], rev, kind) for rev, kind, pos in pending]
+        with self.open() as db:
+            db.executemany("REPLACE INTO patches VALUES (?, ?, ?)", rows)
+            if self.journal:
+                self.restart(db, hashes[-1])
+
+    def restart(self, db, hash):
+        """Start the journal over, after the last done commit and darcs' hash."""
+        db.execute("DELETE FROM journal")
+        db.execute(
+            "INSERT INTO journal VALUES ('start', ?, ?, 0)", (self.last_done, hash)
+        )
+
+    def start(self, rev):
+        """Start journaling the records of an import, darcs is at rev."""
+        self.flush()
+        last = get_last_patches(1)
+        self.journal = True
+        self.last_done = rev
+        with self.open() as db:
+            self.restart(db, last[0] if last else "")
+
+    def write(self, state, rev):
+        """Append a row to the journal, if journaling."""
+        if self.journal:
+            with self.open() as db:
+                db.execute("INSERT INTO journal VALUES (?, ?, NULL, 0)", (state, rev))
+
+    def recording(self, rev, *, final=True):
+        """Journal that a darcs-record of rev is about to run.
+
+        Only the final record completes rev, the others record moves.
+        """
+        self.write("final" if final else "move", rev)
+
+    def recorded(self, rev, *, patches=1):
+        """Journal that the darcs-record of rev is done.
+
+        The hash is read from darcs when flushing, or by `recover`.
+        """
+        if patches:
+            self.add(rev)
+        if self.journal:
+            with self.open() as db:
+                db.execute(
+                    "INSERT INTO journal VALUES ('recorded', ?, NULL, ?)",
+                    (rev, patches),
+                )
+
+    def done(self, rev):
+        """Note that rev was recorded, the journal starts over after it on flush."""
+        self.last_done = rev
+
+    def end(self):
+        """Stop journaling, the import is checkpointed."""
+        self.journal = False
+        with self.open() as db:
+            db.execute("DELETE FROM journal")
+
+    def recover(self):
+        """Get the last commit an interrupted import recorded, None if unknown.
+
+        Reconciles the journal with darcs and maps the patches recorded since it
+        started, a commit that is only partly recorded is obliterated.
+        """
+        rows = (
+            self.open()
+            .execute("SELECT state, rev, hash, patches FROM journal ORDER BY rowid")
+            .fetchall()
+        )
+        if not rows or rows[0][0] != "start":
+            return None
+        (_, last, start, _), *steps = rows
+        records = sum(patches for state, *_, patches in steps if state == "recorded")
+        # Darcs may have finished the last record before it was journaled
+        count = records + 2
+        hashes = get_last_patches(count)
+        if start:
+            if start not in hashes:
+                return None
+            after = hashes.index(start) + 1
+            hashes = hashes[after:]
+        elif len(hashes) == count:
+            return None
+        extra = len(hashes) - records
+        if extra not in (0, 1):
+            return None
+        if extra:
+            if not steps or steps[-1][0] not in ("move", "final"):
+                return None
+            steps.append(("recorded", steps[-1][1], None, 1))
+        hashes = iter(hashes)
+        rows = []
+        current = None
+        for pos, (state, rev, _, patches) in enumerate(steps):
+            if state != "recorded":
+                if rev != current:
+                    current, begun = rev, len(rows)
+                continue
+            rows += [(next(hashes), rev, "record") for _ in range(patches)]
+            if steps[pos - 1][0] == "final":
+                last, current = rev, None
+        if current is not None:
+            # Only the final record completes a commit, moves alone are undone
+            obliterate(len(rows) - begun)
+            del rows[begun:]
+        with self.open() as db:
+            db.executemany("REPLACE INTO patches VALUES (?, ?, ?)", rows)
+        return last
+
+    def insert(self, hash, rev, *, kind="pull"):
+        """Write a patch whose hash is known."""
+        with self.open() as db:
+            db.execute("REPLACE INTO patches VALUES (?, ?, ?)", (hash, rev, kind))
+
+    def get_patch(self, rev):
+        """Get the hash of the last darcs-patch of a git-commit, None if unknown."""
+        row = (
+            self.open()
+            .execute(
+                "SELECT hash FROM patches WHERE rev = ? AND kind != 'checkpoint' "
+                "ORDER BY rowid DESC LIMIT 1",
+                (rev,),
+            )
+            .fetchone()
+        )
+        return row and row[0]
+
+    def get_rev(self, hash):
+        """Get the git-commit of a darcs-patch, None if unknown."""
+        row = (
+            self.open()
+            .execute("SELECT rev FROM patches WHERE hash = ?", (hash,))
+            .fetchone()
+        )
+        return row and row[0]
+
+    def get_recorded(self):
+        """Get the git-commit of darcs' latest patch recorded from git, None if unknown."""
+        count = 64
+        while True:
+            hashes = get_last_patches(count)
+            for hash in reversed(hashes):
+                row = (
+                    self.open()
+                    .execute(
+                        "SELECT rev FROM patches WHERE hash = ? AND kind = 'record'",
+                        (hash,),
+                    )
+                    .fetchone()
+                )
+                if row:
+                    return row[0]
+            if len(hashes) < count:
+                return None
+            count *= 4
+
+    def get_checkpoint(self):
+        """Get the git-commit of the latest checkpoint, None if unknown.
+
+        Only trusted if darcs' latest patch is known, otherwise darcs changed
+        behind our back.
+        """
+        if not _index_file.exists():
+            return None
+        row = (
+            self.open()
+            .execute(
+                "SELECT rev FROM patches WHERE kind = 'checkpoint' "
+                "ORDER BY rowid DESC LIMIT 1"
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None
+        last = get_last_patches(1)
+        if not last or self.get_rev(last[0]) is None:
+            return None
+        return row[0]
+
+    def close(self):
+        """Close the database."""
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+_index = PatchIndex()
+
+
+def resume_journal():
+    """Checkpoint the last commit an interrupted import recorded."""
+    if not _index_file.exists():
+        return
+    not_boring = Path("_darcs", "prefs", "not_boring")
+    if not_boring.exists():
+        not_boring.replace(Path("_darcs", "prefs", "boring"))
+    has_journal = _index.open().execute("SELECT 1 FROM journal LIMIT 1").fetchone()
+    if not has_journal:
+        return
+    rev = _index.recover()
+    if rev:
+        print(f"Resuming the interrupted import after {rev}")
+    else:
+        # The first record after resuming syncs darcs with the whole tree
+        rev = _index.get_recorded()
+        if rev:
+            print(f"The journal doesn't match darcs, resuming after {rev}")
+        else:
+            print("The journal doesn't match darcs, resuming from the last checkpoint")
+    if rev:
+        revert()
+        checkpoint(rev)
+    _index.end()
 
 
 def get_lastest_rev():
     """Get the latest git-commit recorded in darcs."""
+    rev = _index.get_checkpoint()
+    if rev:
+        return rev
     res = []
     start = "git-checkpoint "
     for tag in get_tags():
@@ -525,10 +1876,13 @@ def get_lastest_rev():
     return None
 
 
+@phase("checkpoint")
 def checkpoint(rev):
     """Tag/checkpoint the current git-commit."""
     date = datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f%z")
     tag(f"git-checkpoint {date} {rev}")
+    _index.add(rev, kind="checkpoint")
+    _index.flush()
 
 
 def warning():
@@ -573,63 +1927,622 @@ def ignore_darcs():
         git_add([".gitignore"])
 
 
-def transfer(gen, count, *, last=None):
+def linearize(graph, last):
+    """Get the fast-forward steps (last, rev) of the linearized history."""
+    for rev in graph.linearized():
+        # Check if fast-forward is possible
+        if graph.is_ancestor(rev, last):
+            yield last, rev
+            last = rev
+
+
+def first_parent(graph, last):
+    """Get the steps (last, rev) along the first-parents, one per mainline commit."""
+    # The range is listed in reverse, so the head comes last
+    head = graph.rev(len(graph) - 1)
+    cmd = get_rev_list_cmd(head, last, merges=True)
+    with Popen(cmd[:2] + ["--first-parent"] + cmd[2:], stdout=PIPE) as res:
+        while line := res.stdout.readline():
+            rev = line.decode("UTF-8").strip()
+            yield last, rev
+            last = rev
+
+
+def get_steps(graph, last):
+    """Get the steps of the selected strategy, joined into squash-windows."""
+    if _strategy == "first-parent":
+        return squash(first_parent(graph, last))
+    return squash(linearize(graph, last))
+
+
+def squash(steps):
+    """Join consecutive steps into windows of _squash_count commits or minutes.
+
+    With _squash_before only steps older than it are joined, without a count or
+    minutes they become one window.
+    """
+    if not (_squash_count or _squash_minutes or _squash_before):
+        yield from steps
+        return
+    window = None
+    resumed = False
+    count = 0
+    start = None
+    for prev, rev in steps:
+        date = _meta.get_date(rev) if _meta else None
+        if _squash_before and (date is None or date >= _squash_before):
+            resumed = True
+        if resumed:
+            if window:
+                yield window
+                window = None
+            yield prev, rev
+            continue
+        if window:
+            full = _squash_count and count >= _squash_count
+            if _squash_minutes and date is not None and start is not None:
+                full = full or date - start > _squash_minutes * 60
+            if full:
+                yield window
+                window = None
+        if window:
+            window = (window[0], rev)
+            count += 1
+        else:
+            window = (prev, rev)
+            count = 1
+            start = date
+    if window:
+        yield window
+
+
+def prefetch(last, rev):
+    """Load the git-data needed to record rev on top of last."""
+    blobs = cat_blobs(changed_blobs(rev, last=last))
+    with _blobs_lock:
+        key = (rev, last)
+        if key in _blobs:
+            _blobs[key] = (blobs, _blobs[key][1])
+
+
+def reserve_blobs(last, rev):
+    """Reserve the bytes of the blobs a step is going to prefetch."""
+    global _blobs_size
+    size = sum(_git.size(x) for x in changed_blobs(rev, last=last))
+    with _blobs_lock:
+        _blobs[(rev, last)] = (None, size)
+        _blobs_size += size
+
+
+def prefetched(pool, steps):
+    """Prefetch the next steps in the pool, while the current one is recorded.
+
+    At most _prefetch steps ahead, fewer if their blobs exceed _prefetch_bytes.
+    """
+    pending = deque()
+    for step in steps:
+        reserve_blobs(*step)
+        while pending and (len(pending) >= _prefetch or _blobs_size > _prefetch_bytes):
+            done, future = pending.popleft()
+            # Errors are raised again when the step is recorded
+            future.exception()
+            yield done
+            # In case recording didn't use them
+            pop_blobs(done[1], last=done[0])
+        pending.append((step, pool.submit(prefetch, *step)))
+    while pending:
+        step, future = pending.popleft()
+        future.exception()
+        yield step
+        pop_blobs(step[1], last=step[0])
+
+
+def transfer(graph, *, last=None):
     """Transfer the git-commits to darcs."""
+    steps = list(get_steps(graph, last))
+    pool = ThreadPoolExecutor(max_workers=_prefetch_workers)
+    _index.start(last)
     try:
-        with tqdm(desc="commits", total=count, disable=_disable) as pbar:
+        with tqdm(desc="commits", total=len(steps), disable=_disable) as pbar:
             records = 0
-            for rev in gen:
-                # Check if fast-forward is possible
-                if is_ancestor(rev, last):
-                    record_revision(rev, last=last)
-                    last = rev
-                    records += 1
-                    if records % 100 == 0:
-                        checkpoint(last)
+            for prev, rev in prefetched(pool, steps):
+                # The first record syncs darcs with the whole tree
+                record_revision(rev, last=prev, targeted=_targeted and records > 0)
+                _index.done(rev)
+                last = rev
+                records += 1
+                if records % _checkpoint_every == 0:
+                    _index.flush()
                 pbar.update()
                 if _shutdown:
                     sys.exit(0)
     except Exception:
         print(f"Failed on revision {last}")
         raise
+    finally:
+        pool.shutdown(cancel_futures=True)
+        clear_blobs()
     return last
 
 
-def import_range(rbase, *, from_checkpoint=False):
+def darcs_path(path):
+    """Encode a path like darcs does in patches, escaping whitespace."""
+    res = bytearray(b"./")
+    for char in os.fsencode(path):
+        if char in b" \t\n\r\f\v\\":
+            res += f"\\{char}\\".encode("ASCII")
+        else:
+            res.append(char)
+    return bytes(res)
+
+
+def darcs_hex(data):
+    """Get the hex-lines of a binary primitive."""
+    data = data.hex().encode("ASCII")
+    lines = []
+    for start in range(0, len(data), 78):
+        end = start + 78
+        lines.append(b"*" + data[start:end])
+    return lines
+
+
+def darcs_unpath(path):
+    """Decode a path from a darcs-patch."""
+    if path.startswith(b"./"):
+        path = path[2:]
+    path = re.sub(rb"\\(\d+)\\", lambda x: chr(int(x.group(1))).encode("UTF-8"), path)
+    return os.fsdecode(path)
+
+
+def get_patch_sections(rev, *, last):
+    """Get the sections of `git diff-tree -p -U0`, one per file-pair."""
+    res = run(
+        [
+            "git",
+            "diff-tree",
+            "-r",
+            "-p",
+            "-U0",
+            "-M",
+            "--no-color",
+            "--no-ext-diff",
+            "--no-textconv",
+            "--no-commit-id",
+            last,
+            rev,
+        ],
+        stdout=PIPE,
+        check=True,
+    )
+    out = res.stdout
+    if not out:
+        return []
+    header = b"diff --git "
+    assert out.startswith(header)
+    start = len(header)
+    # Content-lines always start with a prefix, so headers can't be mistaken
+    return out[start:].split(b"\n" + header)
+
+
+def parse_hunks(section):
+    """Get the hunks (line, old, new) of a section in darcs' terms, None if binary."""
+    hunks = []
+    hunk = None
+    for line in section.split(b"\n"):
+        if line.startswith(b"@@ "):
+            _, _, plus, _ = line.split(b" ", 3)
+            start, _, count = plus[1:].partition(b",")
+            start = int(start)
+            # Pure deletions are positioned after the line git names
+            if count == b"0":
+                start += 1
+            hunk = (start, [], [], set())
+            hunks.append(hunk)
+            side = None
+        elif hunk is None:
+            if line.startswith(b"Binary files ") or line == b"GIT binary patch":
+                return None
+        elif line.startswith(b"-"):
+            hunk[1].append(line[1:])
+            side = "old"
+        elif line.startswith(b"+"):
+            hunk[2].append(line[1:])
+            side = "new"
+        elif line.startswith(b"\\"):
+            hunk[3].add(side)
+    return [finish_hunk(*x) for x in hunks]
+
+
+def finish_hunk(start, old, new, noeol):
+    """Translate git's `No newline at end of file` to darcs' empty last line."""
+    if "old" in noeol and "new" not in noeol:
+        new.append(b"")
+    elif "new" in noeol and "old" not in noeol:
+        old.append(b"")
+    return start, old, new
+
+
+def hunk_prims(path, section, old, new):
+    """Get the hunk- or binary-primitives of a section.
+
+    old and new name the git-objects used if git thinks the file is binary.
+    """
+    name = darcs_path(path)
+    hunks = parse_hunks(section)
+    if hunks is None:
+        old = _git.read(old)[1] if old else b""
+        new = _git.read(new)[1] if new else b""
+        return [
+            b"\n".join(
+                [b"binary " + name, b"oldhex"]
+                + darcs_hex(old)
+                + [b"newhex"]
+                + darcs_hex(new)
+            )
+        ]
+    prims = []
+    for start, old, new in hunks:
+        lines = [b"hunk %s %d" % (name, start)]
+        lines += [b"-" + x for x in old]
+        lines += [b"+" + x for x in new]
+        prims.append(b"\n".join(lines))
+    return prims
+
+
+def is_file(mode):
+    """Check if darcs tracks entries of mode as files, it skips symlinks."""
+    return mode.startswith("100")
+
+
+def get_prims(rev, *, last):
+    """Get the darcs-primitives that change the tree of last to rev."""
+    sections = iter(get_patch_sections(rev, last=last))
+    removes = []
+    adddirs = []
+    moves = []
+    rmdirs = []
+    adds = []
+    changes = []
+    for status, old_mode, new_mode, _, path, orig in get_changes(rev, last=last):
+        if _tree_mode in (old_mode, new_mode):
+            if status in "AR":
+                adddirs.append(path)
+            if status in "DR":
+                rmdirs.append(orig or path)
+            continue
+        old = f"{last}:{orig or path}"
+        new = f"{rev}:{path}"
+        old_section = new_section = next(sections)
+        if status == "T":
+            # git splits type-changes into a deletion and a creation
+            new_section = next(sections)
+        elif status == "M" and not is_file(old_mode):
+            continue
+        if status in "MR" and is_file(old_mode):
+            if status == "R":
+                moves.append((orig, path))
+            changes += hunk_prims(path, new_section, old, new)
+            continue
+        if status == "C":
+            raise ValueError(f"Unexpected copy `{orig}` -> `{path}`")
+        if status != "A":
+            if is_file(old_mode):
+                removes.append((orig or path, old_section, old))
+            elif old_mode == _gitlink_mode:
+                rmdirs.append(orig or path)
+        if status != "D":
+            if is_file(new_mode):
+                adds.append((path, new_section, new))
+            elif new_mode == _gitlink_mode:
+                # Submodules are checked out as empty directories
+                adddirs.append(path)
+    prims = []
+    for path, section, old in removes:
+        prims += hunk_prims(path, section, old, None)
+        prims.append(b"rmfile " + darcs_path(path))
+    # Parents first when adding, children first when removing
+    for path in sorted(adddirs, key=lambda x: x.count("/")):
+        prims.append(b"adddir " + darcs_path(path))
+    for orig, path in moves:
+        prims.append(b"move %s %s" % (darcs_path(orig), darcs_path(path)))
+    for path in sorted(rmdirs, key=lambda x: x.count("/"), reverse=True):
+        prims.append(b"rmdir " + darcs_path(path))
+    for path, section, new in adds:
+        prims.append(b"addfile " + darcs_path(path))
+        prims += hunk_prims(path, section, None, new)
+    return prims + changes
+
+
+def patch_info(rev, *, last):
+    """Get the header of the darcs-patch for a commit."""
+    name, comments = get_message(rev, last=last)
+    # darcs record adds a random Ignore-this, so equal patches stay distinct
+    log = [f"Ignore-this: {os.urandom(16).hex()}"] + comments
+    lines = "".join(f"\n {x}" for x in log)
+    return f"[{name}\n{author(rev)}**{commit_date(rev)}{lines}\n] ".encode("UTF-8")
+
+
+def make_patch(step):
+    """Build the darcs-patch of a step (last, rev, info), None if it is empty."""
+    last, rev, info = step
+    prims = get_prims(rev, last=last)
+    if not prims:
+        return None
+    return b"\n".join([info + b"{"] + prims + [b"}"])
+
+
+def get_context():
+    """Get the context darcs needs to apply a bundle to this repository."""
+    res = run(["darcs", "log", "--context"], stdout=PIPE, check=True)
+    context = res.stdout.strip()
+    if not context.startswith(b"Context:"):
+        context = b"Context:\n\n" + context
+    return context
+
+
+@phase("apply")
+def apply_bundle(bundle, patches):
+    """Apply patches with one `darcs apply`."""
+    with bundle.open("wb") as f:
+        f.write(b"\nNew patches:\n\n")
+        f.write(b"\n".join(patches))
+        f.write(b"\n\n")
+        f.write(get_context())
+        f.write(b"\n")
+    res = run(
+        ["darcs", "apply", "--all", "--no-allow-conflicts", str(bundle)],
+        check=True,
+        stdout=PIPE,
+    )
+    if _verbose:
+        print(res.stdout.decode("UTF-8").strip())
+
+
+def sync_head(rev):
+    """Point git at rev after darcs changed the working-tree.
+
+    Restores what darcs doesn't track, returns the paths where the working-tree
+    differs from rev otherwise.
+    """
+    set_head(rev)
+    # darcs doesn't track the exec-bit, so only contents count as different
+    no_mode = ["git", "-c", "core.fileMode=false"]
+    run(no_mode + ["update-index", "-q", "--refresh"])
+    res = run(no_mode + ["diff-files", "-z", "--name-only"], stdout=PIPE, check=True)
+    changed = set(res.stdout.split(b"\0"))
+    res = run(["git", "diff-files", "-z"], stdout=PIPE, check=True)
+    fields = res.stdout.split(b"\0")
+    restore = []
+    differ = []
+    for pos in range(0, len(fields) - 1, 2):
+        mode = fields[pos][1:].decode("ASCII").split()[0]
+        path = fields[pos + 1]
+        restore.append(path)
+        if is_file(mode) and path in changed:
+            differ.append(os.fsdecode(path))
+    if restore:
+        run(
+            ["git", "checkout-index", "--force", "-z", "--stdin"],
+            input=b"\0".join(restore),
+            check=True,
+        )
+    res = run(
+        ["git", "ls-files", "-z", "--others", "--exclude-standard", "-x", "/_darcs"],
+        stdout=PIPE,
+        check=True,
+    )
+    for path in res.stdout.split(b"\0"):
+        if not path:
+            continue
+        path = Path(os.fsdecode(path))
+        # Symlinks git removed, darcs doesn't know them
+        if path.is_symlink():
+            path.unlink()
+        else:
+            differ.append(str(path))
+    return differ
+
+
+def verify_tree(rev, differ, *, files=False):
+    """Fail if darcs' working-tree differs from rev.
+
+    If files is set, the file-list of darcs' pristine is compared, too.
+    """
+    differ = set(differ)
+    if files:
+        differ |= get_darcs_files() ^ get_git_files()
+    differ = sorted(differ)
+    if differ:
+        paths = "\n".join(differ[:10])
+        raise ClickException(f"darcs differs from git at {rev} in:\n{paths}")
+
+
+def get_darcs_files():
+    """Get the files in the pristine-tree of darcs."""
+    res = run(["darcs", "show", "files", "--no-directories"], stdout=PIPE, check=True)
+    files = set()
+    for path in res.stdout.split(b"\n"):
+        path = os.fsdecode(path)
+        if path.startswith("./"):
+            path = path[2:]
+        if path and path != ".":
+            files.add(path)
+    return files
+
+
+def get_git_files():
+    """Get the files darcs would track in the index of git."""
+    res = run(["git", "ls-files", "-z", "--stage"], stdout=PIPE, check=True)
+    files = set()
+    for entry in res.stdout.split(b"\0"):
+        if not entry:
+            continue
+        info, _, path = entry.partition(b"\t")
+        if is_file(info.decode("ASCII").split()[0]):
+            files.add(os.fsdecode(path))
+    return files
+
+
+def transfer_bundles(graph, *, last=None):
+    """Transfer the git-commits to darcs, applying native patches in bundles."""
+    steps = [
+        (prev, rev, patch_info(rev, last=prev)) for prev, rev in get_steps(graph, last)
+    ]
+    bundle = Path("_darcs", f"{_uuid}.dpatch")
+    try:
+        with ProcessPoolExecutor() as pool, tqdm(
+            desc="commits", total=len(steps), disable=_disable
+        ) as pbar:
+            for start in range(0, len(steps), _checkpoint_every):
+                end = start + _checkpoint_every
+                window = steps[start:end]
+                patches = pool.map(make_patch, window, chunksize=4)
+                patches = [
+                    (rev, patch)
+                    for (_, rev, _), patch in zip(window, patches)
+                    if patch is not None
+                ]
+                if patches:
+                    apply_bundle(bundle, [x for _, x in patches])
+                    for rev, _ in patches:
+                        _index.add(rev)
+                last = window[-1][1]
+                differ = sync_head(last)
+                verify_tree(last, differ, files=_verify)
+                checkpoint(last)
+                pbar.update(len(window))
+                if _shutdown:
+                    sys.exit(0)
+    except Exception:
+        print(f"Failed on revision {last}")
+        raise
+    finally:
+        bundle.unlink(missing_ok=True)
+    return last
+
+
+def import_range(rbase, *, from_checkpoint=False, rhead=None):
     """Run the transfer to darcs."""
-    rhead = get_head()
+    global _meta
+    rhead = rhead or get_head()
+    rbase = rev_parse(rbase)
     if rbase == rhead:
         return
-    count = 0
-    for _ in get_rev_list(rhead, rbase):
-        count += 1
-    if count == 0:
+    graph = get_commit_graph(rhead, rbase)
+    if not graph:
         return
-    gen = get_rev_list(rhead, rbase)
+    _meta = get_commit_meta(rhead, rbase)
     wipe()
     checkout(rbase)
     with less_boring():
+        failed = True
         try:
             last = rbase
             if not from_checkpoint:
                 record_all(rbase)
-            last = transfer(gen, count, last=last)
+            if _engine == "bundle":
+                last = transfer_bundles(graph, last=last)
+            else:
+                last = transfer(graph, last=last)
             if last != rhead:
                 checkout(rhead)
                 record_all(rhead)
+                _index.done(rhead)
+            failed = False
         finally:
-            checkpoint(rhead)
-            optimize()
+            # An interrupted import is resumed from the journal
+            if not failed:
+                checkpoint(rhead)
+                _index.end()
+            maintenance()
 
 
-def import_one():
+def import_one(head=None):
     """Import current revisiion."""
-    head = get_head()
+    head = head or get_head()
     wipe()
     checkout(head)
     record_all(head)
     checkpoint(head)
-    optimize()
+    maintenance()
+
+
+def get_repo_stats():
+    """Get cheap statistics (patches, inventory, pristine) of the darcs-repo."""
+    inventory = 0
+    with Path("_darcs", "hashed_inventory").open("rb") as f:
+        for line in f:
+            if line.startswith(b"hash: "):
+                inventory += 1
+    with os.scandir(Path("_darcs", "patches")) as it:
+        patches = sum(1 for _ in it)
+    with os.scandir(Path("_darcs", "pristine.hashed")) as it:
+        pristine = sum(x.stat().st_size for x in it if x.is_file())
+    return {"patches": patches, "inventory": inventory, "pristine": pristine}
+
+
+def get_due_steps(stats):
+    """Get the optimize-steps that are due."""
+    db = _index.open()
+    due = []
+    for step, limit in _maintenance_due.items():
+        row = db.execute(
+            "SELECT patches, pristine FROM maintenance WHERE step = ? "
+            "ORDER BY rowid DESC LIMIT 1",
+            (step,),
+        ).fetchone()
+        patches, pristine = row or (0, 0)
+        if stats["patches"] - patches >= limit:
+            due.append(step)
+        # Every record leaves stale files in the pristine
+        elif step == "clean" and pristine and stats["pristine"] > 2 * pristine:
+            due.append(step)
+    return due
+
+
+def run_maintenance(steps):
+    """Run optimize-steps and record their timings."""
+    for step in steps:
+        started = time()
+        start = monotonic()
+        optimize(step)
+        seconds = monotonic() - start
+        stats = get_repo_stats()
+        if _verbose:
+            print(f"optimize {step}: {seconds:.2f}s {stats}")
+        with _index.open() as db:
+            db.execute(
+                "INSERT INTO maintenance VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    step,
+                    started,
+                    seconds,
+                    stats["patches"],
+                    stats["inventory"],
+                    stats["pristine"],
+                ),
+            )
+
+
+def maintenance():
+    """Run the repository-maintenance after an update, as configured."""
+    if _maintenance == "none":
+        return
+    if _maintenance == "all":
+        steps = list(_maintenance_due)
+    else:
+        steps = get_due_steps(get_repo_stats())
+    if not steps:
+        return
+    if _maintenance == "background":
+        # Detached, so cron doesn't wait and CTRL-C doesn't interrupt it
+        Popen(
+            [sys.executable, "-c", "from git_darcs import main; main()", "maintain"],
+            stdout=DEVNULL,
+            start_new_session=True,
+        )
+        return
+    run_maintenance(steps)
 
 
 def fix_pwd():
@@ -658,6 +2571,16 @@ def prepare_update(base, shallow):
         raise ClickException("Please run git-darcs in the root of your git-repo.")
     if not Path("_darcs").exists():
         initialize()
+    res = find_base(base, shallow)
+    if _isatty:
+        _thread = Thread(target=handle_shutdown, daemon=True)
+        _thread.start()
+    return res
+
+
+def find_base(base, shallow):
+    """Find the base to import from, resuming an interrupted import first."""
+    resume_journal()
     rbase = get_lastest_rev()
     from_checkpoint = False
     if rbase:
@@ -677,13 +2600,10 @@ def prepare_update(base, shallow):
         if shallow is False:
             do_one = False
             rbase = get_base()
-    if _isatty:
-        _thread = Thread(target=handle_shutdown, daemon=True)
-        _thread.start()
     return rbase, from_checkpoint, do_one
 
 
-def run_update(rbase, from_checkpoint, do_one):
+def run_update(rbase, from_checkpoint, do_one, *, head=None):
     """Run conversion loop."""
     branch = get_current_branch()
     failed = True
@@ -693,9 +2613,9 @@ def run_update(rbase, from_checkpoint, do_one):
         except CalledProcessError:
             pass
         if do_one:
-            import_one()
+            import_one(head)
         else:
-            import_range(rbase, from_checkpoint=from_checkpoint)
+            import_range(rbase, from_checkpoint=from_checkpoint, rhead=head)
         failed = False
     finally:
         if branch:
@@ -706,6 +2626,200 @@ def run_update(rbase, from_checkpoint, do_one):
                 checkout(branch)
 
 
+class RefWatch:
+    """Waits for changes of git's refs, using inotify or polling."""
+
+    def __init__(self):
+        """Dear flake8 this is a init function."""
+        self.fd = None
+        self.dirs = {}
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            self.add_watch = libc.inotify_add_watch
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (AttributeError, OSError):
+            return
+        if fd < 0:
+            return
+        self.fd = fd
+        self.watch(Path(".git"), recursive=False)
+        self.watch(Path(".git", "refs"))
+
+    def watch(self, path, *, recursive=True):
+        """Add inotify-watches for path and its sub-directories."""
+        dirs = [path]
+        if recursive:
+            dirs += [x for x in path.rglob("*") if x.is_dir()]
+        for dir in dirs:
+            wd = self.add_watch(self.fd, os.fsencode(dir), _inotify_mask)
+            if wd >= 0:
+                self.dirs[wd] = dir
+
+    def read(self):
+        """Read pending events, True if a ref might have changed."""
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return False
+        changed = False
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, size = struct.unpack_from("iIII", data, pos)
+            pos += 16
+            end = pos + size
+            name = data[pos:end].rstrip(b"\0")
+            pos = end
+            if mask & _in_ignored:
+                self.dirs.pop(wd, None)
+                continue
+            dir = self.dirs.get(wd)
+            if dir is None or name.endswith(b".lock"):
+                continue
+            if mask & _in_isdir and mask & (_in_create | _in_moved_to):
+                self.watch(dir / os.fsdecode(name))
+            if dir == Path(".git") and name not in (b"HEAD", b"packed-refs"):
+                continue
+            changed = True
+        return changed
+
+    def wait(self, timeout):
+        """Wait till a ref changed or timeout, return early on shutdown."""
+        end = monotonic() + timeout
+        while not _shutdown and (left := end - monotonic()) > 0:
+            if self.fd is None:
+                sleep(min(left, 0.5))
+                continue
+            ready, _, _ = select.select([self.fd], [], [], min(left, 0.5))
+            if ready and self.read():
+                # A fetch updates many refs, wait till it is done
+                while select.select([self.fd], [], [], 0.2)[0]:
+                    self.read()
+                return
+
+    def close(self):
+        """Close the inotify-instance."""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def watch_ref(ref, interval):
+    """Import new commits of ref, whenever git changes it."""
+    signal.signal(signal.SIGTERM, handle_signal)
+    rbase, from_checkpoint, do_one = prepare_update(None, None)
+    if do_one:
+        run_update(rbase, from_checkpoint, do_one)
+    last = seen = get_lastest_rev()
+    refs = RefWatch()
+    if refs.fd is None:
+        print(f"inotify is not available, polling every {interval} seconds")
+    try:
+        while not _shutdown:
+            head = _git.resolve(f"{ref}^{{commit}}")
+            if head and head != seen:
+                seen = head
+                print(f"Importing `{ref}` at {head}")
+                run_update(last, True, False, head=head)
+                # Only what darcs recorded counts, ref may have been rewound
+                imported = get_lastest_rev()
+                if imported != head:
+                    print(f"`{ref}` does not descend from {last}, not imported")
+                last = imported
+            refs.wait(interval)
+    finally:
+        refs.close()
+
+
+@contextmanager
+def in_repo(path):
+    """Work in another tracking-repository, with its own git-session and index."""
+    global _attributes
+    cwd = Path.cwd()
+    _git.close()
+    _index.close()
+    _attributes = None
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        _git.close()
+        _index.close()
+        _attributes = None
+        os.chdir(cwd)
+
+
+def sibling_path(branch):
+    """Get the path of the tracking-repository of a branch, next to this one."""
+    name = branch.replace("/", "-")
+    return Path("..", f"{Path.cwd().name}-{name}")
+
+
+def get_fork_point(rev):
+    """Get the newest ancestor of rev darcs has a patch of, and that patch."""
+    with Popen(["git", "rev-list", "--topo-order", rev], stdout=PIPE) as res:
+        for line in res.stdout:
+            commit = line.decode("UTF-8").strip()
+            patch = _index.get_patch(commit)
+            if patch:
+                return commit, patch
+    return None, None
+
+
+def fork_repo(destination, branch, rev):
+    """Fork this tracking-repository at rev, sharing git-objects and darcs-files.
+
+    Darcs is forked at the newest ancestor of rev it has a patch of, if there is
+    none the fork starts with an empty darcs-repo.
+    """
+    source = Path.cwd()
+    run(
+        ["git", "clone", "-q", "--shared", "--no-checkout", ".", destination],
+        check=True,
+    )
+    fork, patch = get_fork_point(rev)
+    if fork:
+        darcs_dest = Path(destination, _uuid)
+        try:
+            darcs_clone(".", darcs_dest, working=False, patch=patch)
+            adopt_darcs(darcs_dest, destination)
+        finally:
+            rmtree(darcs_dest, ignore_errors=True)
+        _index.close()
+        copy(_index_file, Path(destination, _index_file))
+    with in_repo(destination):
+        if fork:
+            relink(source)
+            run(["git", "checkout", "-q", "-B", branch, fork], check=True)
+            checkpoint(fork)
+        else:
+            initialize()
+
+
+def update_branches(branches, base, shallow):
+    """Import HEAD here and branches into sibling tracking-repositories.
+
+    Branches without a repository yet are forked where they leave the history
+    of HEAD, so the shared history is only recorded once.
+    """
+    revs = {x: rev_parse(x) for x in branches}
+    siblings = {x: sibling_path(x) for x in branches}
+    run_update(*prepare_update(base, shallow))
+    for branch in branches:
+        if _shutdown:
+            break
+        if not siblings[branch].exists():
+            rev = get_merge_base([get_head(), revs[branch]])
+            print(f"Forking `{branch}` into {siblings[branch]}")
+            fork_repo(siblings[branch], branch, rev)
+        with in_repo(siblings[branch]):
+            print(f"Importing `{branch}` into {siblings[branch]}")
+            run(
+                ["git", "checkout", "-q", "-f", "-B", branch, revs[branch]],
+                check=True,
+            )
+            run_update(*find_base(base, shallow))
+
+
 def ask(question, choice, *, text="", state="", help=""):
     """Ask a question on the terminal."""
     key = "?"
@@ -721,13 +2835,319 @@ def ask(question, choice, *, text="", state="", help=""):
     return key
 
 
+def parse_bundle(data):
+    """Get the patches (hash, prims) of a darcs-bundle.
+
+    Raises ValueError if it contains something we can't replay.
+    """
+    start = data.index(b"\nNew patches:\n")
+    end = data.index(b"\nContext:\n", start)
+    lines = data[start:end].split(b"\n")[2:]
+    patches = []
+    pos = 0
+
+    def get(pos):
+        if pos >= len(lines):
+            raise ValueError("Truncated patch in bundle")
+        return lines[pos]
+
+    while pos < len(lines):
+        line = lines[pos]
+        pos += 1
+        if not line.strip():
+            continue
+        match = _darcs_author.match(get(pos))
+        if not line.startswith(b"[") or not match:
+            raise ValueError("Unexpected patch-info in bundle")
+        pos += 1
+        name = line[1:]
+        by, inverted, date, tail = match.groups()
+        log = []
+        if tail is None:
+            while get(pos).startswith(b" "):
+                log.append(lines[pos][1:])
+                pos += 1
+            tail = lines[pos][1:]
+            pos += 1
+        tail = tail.strip()
+        if tail == b"<":
+            # Explicit dependencies, of tags for example
+            while not get(pos).startswith(b">"):
+                pos += 1
+            tail = lines[pos][1:].strip()
+            pos += 1
+        if tail != b"{":
+            raise ValueError("Unexpected patch in bundle")
+        body = []
+        while get(pos) != b"}":
+            body.append(lines[pos])
+            pos += 1
+        pos += 1
+        flag = b"t" if inverted == b"-" else b"f"
+        hash = hashlib.sha1(name + by + date + b"".join(log) + flag).hexdigest()
+        patches.append((hash, parse_prims(body)))
+    return patches
+
+
+def parse_prims(lines):
+    """Parse the primitives of a darcs-patch."""
+    prims = []
+    pos = 0
+
+    def prefixed(prefix):
+        nonlocal pos
+        res = []
+        while pos < len(lines) and lines[pos].startswith(prefix):
+            res.append(lines[pos][1:])
+            pos += 1
+        return res
+
+    while pos < len(lines):
+        kind, _, rest = lines[pos].partition(b" ")
+        pos += 1
+        if kind == b"hunk":
+            path, _, line = rest.rpartition(b" ")
+            # darcs send adds context-lines
+            prefixed(b" ")
+            old = prefixed(b"-")
+            new = prefixed(b"+")
+            prefixed(b" ")
+            prims.append(("hunk", darcs_unpath(path), int(line), old, new))
+        elif kind in (b"addfile", b"rmfile", b"adddir", b"rmdir"):
+            prims.append((kind.decode("ASCII"), darcs_unpath(rest)))
+        elif kind == b"move":
+            orig, new = rest.split(b" ")
+            prims.append(("move", darcs_unpath(orig), darcs_unpath(new)))
+        elif kind == b"binary":
+            if pos >= len(lines) or lines[pos] != b"oldhex":
+                raise ValueError("Unexpected binary-patch in bundle")
+            pos += 1
+            old = bytes.fromhex(b"".join(prefixed(b"*")).decode("ASCII"))
+            if pos >= len(lines) or lines[pos] != b"newhex":
+                raise ValueError("Unexpected binary-patch in bundle")
+            pos += 1
+            new = bytes.fromhex(b"".join(prefixed(b"*")).decode("ASCII"))
+            prims.append(("binary", darcs_unpath(rest), old, new))
+        elif kind == b"changepref":
+            # Only changes _darcs/prefs
+            pos += 2
+            if pos > len(lines):
+                raise ValueError("Truncated changepref in bundle")
+        elif kind:
+            raise ValueError(f"Unsupported darcs-primitive `{kind.decode()}`")
+    return prims
+
+
+class TreeReplay:
+    """Replays darcs-primitives on a git-tree in memory."""
+
+    def __init__(self, rev):
+        """Dear flake8 this is a init function."""
+        self.files = {}
+        self.changed = set()
+        res = run(["git", "ls-tree", "-r", "-z", rev], stdout=PIPE, check=True)
+        for entry in res.stdout.split(b"\0"):
+            if entry:
+                info, _, path = entry.partition(b"\t")
+                mode, _, sha = info.decode("ASCII").split()
+                self.files[os.fsdecode(path)] = [mode, sha, None]
+
+    def data(self, path):
+        """Get the contents of a file."""
+        entry = self.files.get(path)
+        if entry is None:
+            raise ValueError(f"darcs changes unknown file `{path}`")
+        if entry[2] is None:
+            _, entry[2] = _git.read(entry[1])
+        return entry[2]
+
+    def apply(self, prim):
+        """Apply a primitive."""
+        kind, path = prim[:2]
+        files = self.files
+        if kind == "hunk":
+            _, _, line, old, new = prim
+            lines = self.data(path).split(b"\n")
+            start = line - 1
+            end = start + len(old)
+            if lines[start:end] != old:
+                raise ValueError(f"darcs-hunk doesn't apply to `{path}`")
+            lines[start:end] = new
+            files[path][2] = b"\n".join(lines)
+        elif kind == "binary":
+            _, _, old, new = prim
+            if self.data(path) != old:
+                raise ValueError(f"darcs-binary doesn't apply to `{path}`")
+            files[path][2] = new
+        elif kind == "addfile":
+            if path in files:
+                raise ValueError(f"darcs adds existing file `{path}`")
+            files[path] = ["100644", None, b""]
+        elif kind == "rmfile":
+            if self.data(path):
+                raise ValueError(f"darcs removes non-empty file `{path}`")
+            del files[path]
+        elif kind == "move":
+            _, orig, new = prim
+            if orig in files:
+                moves = [(orig, new)]
+            else:
+                prefix = f"{orig}/"
+                start = len(prefix)
+                moves = [
+                    (x, f"{new}/{x[start:]}") for x in files if x.startswith(prefix)
+                ]
+            for orig, new in moves:
+                files[new] = files.pop(orig)
+                self.changed.add(orig)
+                self.changed.add(new)
+        # git doesn't know directories
+        if kind in ("hunk", "binary", "addfile", "rmfile"):
+            self.changed.add(path)
+
+    def entries(self):
+        """Get the mode and blob-hash of every file."""
+        res = run(["git", "rev-parse", "--show-object-format"], stdout=PIPE, check=True)
+        algorithm = res.stdout.decode("ASCII").strip()
+        entries = {}
+        for path, (mode, sha, data) in self.files.items():
+            if data is not None:
+                blob = hashlib.new(algorithm, b"blob %d\0" % len(data))
+                blob.update(data)
+                sha = blob.hexdigest()
+            entries[path] = (mode, sha)
+        return entries
+
+    def ignore_darcs(self):
+        """Add the `.gitignore` of ignore_darcs, if there is none."""
+        if ".gitignore" not in self.files:
+            self.files[".gitignore"] = ["100644", None, _gitignore.encode("UTF-8")]
+            self.changed.add(".gitignore")
+
+    def changes(self):
+        """Get what changed since the last call as (path, mode, sha, data).
+
+        mode is None for deleted files.
+        """
+        res = []
+        for path in sorted(self.changed):
+            entry = self.files.get(path)
+            if entry is None:
+                res.append((path, None, None, None))
+            else:
+                res.append((path, *entry))
+        self.changed = set()
+        return res
+
+
+def clean_message(message):
+    """Clean a message like `git commit -m` does."""
+    res = []
+    for line in message.splitlines():
+        line = line.rstrip()
+        if line or (res and res[-1]):
+            res.append(line)
+    while res and not res[-1]:
+        res.pop()
+    if not res:
+        raise ValueError("Empty commit-message")
+    return "\n".join(res) + "\n"
+
+
+def fast_import_path(path):
+    """Quote a path for `git fast-import` if needed."""
+    path = os.fsencode(path)
+    if b"\n" in path or path.startswith(b'"'):
+        path = path.replace(b"\\", b"\\\\").replace(b'"', b'\\"')
+        path = b'"' + path.replace(b"\n", b"\\n") + b'"'
+    return path
+
+
+def git_var(name):
+    """Get a git logical variable."""
+    res = run(["git", "var", name], stdout=PIPE, check=True)
+    return res.stdout.strip()
+
+
+def diff_worktree(rev):
+    """Get the paths whose contents in the working-tree differ from rev."""
+    index = Path("_darcs", f"{_uuid}.index").absolute()
+    env = dict(os.environ)
+    env["GIT_INDEX_FILE"] = str(index)
+    no_mode = ["git", "-c", "core.fileMode=false"]
+    try:
+        run(["git", "read-tree", rev], env=env, check=True)
+        run(no_mode + ["update-index", "-q", "--refresh"], env=env)
+        res = run(
+            no_mode + ["diff-files", "-z", "--name-only"],
+            env=env,
+            stdout=PIPE,
+            check=True,
+        )
+    finally:
+        index.unlink(missing_ok=True)
+    return {os.fsdecode(x) for x in res.stdout.split(b"\0") if x}
+
+
+@phase("commit")
+def fast_import(ref, parent, commits):
+    """Create commits (message, changes) on ref with one `git fast-import`.
+
+    Returns the hashes of the commits.
+    """
+    marks = Path("_darcs", f"{_uuid}.marks")
+    author = git_var("GIT_AUTHOR_IDENT")
+    committer = git_var("GIT_COMMITTER_IDENT")
+    with Popen(
+        ["git", "fast-import", "--quiet", f"--export-marks={marks}"], stdin=PIPE
+    ) as proc:
+        write = proc.stdin.write
+        for mark, (message, changes) in enumerate(commits, 1):
+            message = message.encode("UTF-8")
+            write(b"commit %s\nmark :%d\n" % (ref.encode("UTF-8"), mark))
+            write(b"author %s\ncommitter %s\n" % (author, committer))
+            write(b"data %d\n%s\n" % (len(message), message))
+            if mark == 1:
+                write(b"from %s\n" % parent.encode("ASCII"))
+            for path, mode, sha, data in changes:
+                path = fast_import_path(path)
+                if mode is None:
+                    write(b"D %s\n" % path)
+                elif data is None:
+                    write(b"M %s %s %s\n" % (mode.encode(), sha.encode(), path))
+                else:
+                    write(b"M %s inline %s\n" % (mode.encode(), path))
+                    write(b"data %d\n%s\n" % (len(data), data))
+            write(b"\n")
+    if proc.returncode:
+        raise CalledProcessError(proc.returncode, proc.args)
+    revs = {}
+    with marks.open("r", encoding="ASCII") as f:
+        for line in f:
+            mark, rev = line.split()
+            revs[int(mark[1:])] = rev
+    marks.unlink()
+    return [revs[x] for x in range(1, len(commits) + 1)]
+
+
 class Patch:
     """Represents a darcs-patch."""
 
+    __slots__ = (
+        "source",
+        "author",
+        "hash",
+        "chash",
+        "date",
+        "subject",
+        "comment",
+        "paths",
+        "pull",
+    )
+
     def __init__(self, source, patch):
         """Dear flake8 this is a init function."""
         self.source = source
-        self.patch = patch
         fields = patch.attrib
         self.author = fields["author"]
         self.hash = fields["hash"]
@@ -738,6 +3158,21 @@ class Patch:
         if comment.startswith("Ignore-this: "):
             comment = os.linesep.join(comment.splitlines()[1:])
         self.comment = comment.strip()
+        self.paths = None
+        summary = patch.find("summary")
+        if summary is not None:
+            self.paths = []
+            for change in summary:
+                if change.tag == "move":
+                    paths = [change.attrib["from"], change.attrib["to"]]
+                else:
+                    paths = [change.text or ""]
+                for path in paths:
+                    path = path.strip()
+                    if path.startswith("./"):
+                        path = path[2:]
+                    if path:
+                        self.paths.append(path)
         self.pull = None
 
     def short(self):
@@ -800,18 +3235,23 @@ class Pull:
         self.source = source
         self.args = args
         self.ignore_temp = ignore_temp
-        self.patches_xml = get_patches(source, args)
+        self.remote = []
+        self.depends = None
         self.patches = OrderedDict()  # Legacy support
-        for patch in self.patches_xml:
+        self.skipped = False
+        for patch in get_patches(source, args):
             obj = Patch(source, patch)
+            self.remote.append(obj.hash)
             if self.ignore_temp:
                 if not obj.subject.startswith("temp: "):
                     self.patches[obj.hash] = obj
+                else:
+                    self.skipped = True
             else:
                 self.patches[obj.hash] = obj
 
-    def pull(self, all=False):
-        """Pull patches."""
+    def pull(self, all=False, batch=False):
+        """Pull patches, in batch-mode with one `darcs apply` and `git fast-import`."""
         if not self.patches:
             print("No remote patches to pull in!")
             return
@@ -827,21 +3267,134 @@ class Pull:
             if key in ("n", "q", "c"):
                 print("Cancel pull")
                 sys.exit(1)
-        with tqdm(desc="pull", total=count, disable=_disable) as pbar:
+        self.pull_selected(pull, batch)
+
+    @phase("pull-selected")
+    def pull_selected(self, pull, batch):
+        """Pull the selected patches, without asking."""
+        if batch and len(pull) > 1:
+            try:
+                pull = self.pull_batch(pull)
+            except ValueError as e:
+                print(f"Pulling patch by patch: {e}")
+        with tqdm(desc="pull", total=len(pull), disable=_disable) as pbar:
             for patch in pull:
                 pull_patch(self.source, patch.hash)
                 with ignore_darcs():
-                    git_add()
+                    # darcs might pull skipped patches along, we don't know their paths
+                    if patch.paths is None or self.skipped:
+                        git_add()
+                    else:
+                        git_stage(patch.paths)
                 git_commit(patch.message())
+                _index.insert(patch.hash, get_head())
                 pbar.update()
 
+    def pull_batch(self, pull):
+        """Pull patches with one `darcs apply`, commit them with `git fast-import`.
+
+        Raises ValueError before changing anything, if the bundle can't be replayed.
+        Returns the patches still to pull.
+        """
+        branch = get_current_branch()
+        if not branch:
+            raise ValueError("HEAD is detached")
+        selected = {x.hash: x for x in pull}
+        head = get_head()
+        bundle = Path("_darcs", f"{_uuid}.dpatch")
+        ref = f"refs/git-darcs/{_uuid}"
+        try:
+            send_bundle(self.source, list(selected), bundle)
+            patches = parse_bundle(bundle.read_bytes())
+            if not set(selected) <= {x for x, _ in patches}:
+                raise ValueError("The bundle doesn't contain the selected patches")
+            tree = TreeReplay(head)
+            # Only committed, ignore_darcs removes it from the working-tree
+            ignore = {".gitignore"} - set(tree.files)
+            commits = []
+            hashes = []
+            # Patches that aren't selected (ignored temporary ones) are part of the
+            # next commit, like darcs pulls them along
+            for hash, prims in patches:
+                for prim in prims:
+                    tree.apply(prim)
+                patch = selected.get(hash)
+                if patch is not None:
+                    # Like `git add .` in ignore_darcs in the patch by patch loop
+                    if patch.paths is None or self.skipped:
+                        tree.ignore_darcs()
+                    commits.append((clean_message(patch.message()), tree.changes()))
+                    hashes.append(hash)
+            revs = fast_import(ref, head, commits)
+            with tqdm(desc="apply", total=1, disable=_disable) as pbar:
+                run(["darcs", "apply", "--all", str(bundle)], check=True)
+                pbar.update()
+            differ = diff_worktree(revs[-1]) - ignore
+            if differ:
+                raise ClickException(
+                    f"darcs' working-tree differs from the pulled patches in: "
+                    f"{', '.join(sorted(differ))}"
+                )
+            run(
+                ["git", "update-ref", f"refs/heads/{branch}", revs[-1], head],
+                check=True,
+            )
+            run(["git", "reset", "-q"], check=True)
+        finally:
+            bundle.unlink(missing_ok=True)
+            run(["git", "update-ref", "-d", ref])
+        for hash, rev in zip(hashes, revs):
+            _index.insert(hash, rev)
+        return []
+
+    def load_depends(self):
+        """Load the dependencies between the remote patches, False if unsupported."""
+        remote = self.remote
+        if not remote:
+            return False
+        # The patches before the first remote one are all common
+        graph = get_dependencies(self.source, remote[0])
+        if not graph:
+            return False
+        prefixes = {}
+        for size in {len(x) for x in graph}:
+            for hash in remote:
+                prefixes[hash[:size]] = hash
+        # Patches we already have are not part of the remote ones
+        depends = {}
+        for node, deps in graph.items():
+            hash = prefixes.get(node)
+            if hash:
+                depends[hash] = [prefixes[x] for x in deps if x in prefixes]
+        if remote and not depends:
+            # Not the output we expected
+            return False
+        return depends
+
+    def get_depends(self, hash):
+        """Get a patch and the remote patches it depends on."""
+        if self.depends is None:
+            self.depends = self.load_depends()
+        if self.depends is False:
+            xml = get_patches(self.source, ["-h", hash])
+            return [x.attrib["hash"] for x in xml]
+        res = [hash]
+        seen = {hash}
+        for current in res:
+            for dep in self.depends.get(current, ()):
+                if dep not in seen:
+                    seen.add(dep)
+                    res.append(dep)
+        return res
+
     def pull_depends(self, hash):
         """Find dependent patches an set pull to True for these, too."""
-        xml = get_patches(self.source, ["-h", hash])
         count = 0
-        for patch in xml:
-            hash = patch.attrib["hash"]
-            patch = self.patches[hash]
+        for dep in self.get_depends(hash):
+            patch = self.patches.get(dep)
+            # Ignored temporary patches are pulled by darcs anyway
+            if patch is None:
+                continue
             if not patch.pull:
                 count += 1
                 patch.pull = True
@@ -850,40 +3403,54 @@ class Pull:
 
     def decide(self):
         """Decide patches to pull."""
-        decide = OrderedDict(self.patches)
-        while decide:
-            key = None
-            of = len(decide)
-            for index, (hash, patch) in enumerate(OrderedDict(decide).items()):
-                key = patch.ask(index, of)
-                if patch.pull is not None:
-                    if patch.pull:
-                        self.pull_depends(hash)
-                    decide.pop(hash)
+        patches = list(self.patches.values())
+        decide = range(len(patches))
+        key = None
+        rest = []
+        of = len(decide)
+        for pos in decide:
+            patch = patches[pos]
+            key = patch.ask(pos, of)
+            if patch.pull is None:
+                rest.append(pos)
+            elif patch.pull:
+                self.pull_depends(patch.hash)
+            if key in ("a", "i"):
+                rest.extend(range(pos + 1, of))
+                break
+            elif key in ("c", "q"):
+                print("Cancel pull")
+                sys.exit(1)
+
+        with tqdm(desc="resolve", total=len(rest), disable=_disable) as pbar:
+            for pos in rest:
+                patch = patches[pos]
                 if key == "a":
-                    break
+                    patch.pull = True
+                    self.pull_depends(patch.hash)
                 elif key == "i":
-                    break
-                elif key in ("c", "q"):
-                    print("Cancel pull")
-                    sys.exit(1)
-
-            of = len(decide)
-            with tqdm(desc="resolve", total=of, disable=_disable) as pbar:
-                for hash, patch in OrderedDict(decide).items():
-                    if key == "a":
-                        patch.pull = True
-                        self.pull_depends(hash)
-                    elif key == "i":
-                        patch.pull = False
-                    decide.pop(hash)
-                    pbar.update()
+                    patch.pull = False
+                pbar.update()
 
 
 @click.group()
-def main():
+@click.option(
+    "--trace",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Write a Chrome trace of all processes and phases to FILE",
+)
+@click.pass_context
+def main(ctx, trace):
     """Click entrypoint."""
+    write_timings = start_timings()
+    if trace:
+        ctx.call_on_close(start_trace(trace))
     fix_pwd()
+    ctx.call_on_close(_git.close)
+    ctx.call_on_close(_index.close)
+    if write_timings:
+        ctx.call_on_close(write_timings)
 
 
 @main.command()
@@ -894,27 +3461,33 @@ def clone(source, destination, verbose):
     """Locally clone a tracking-repository to get a working-repository."""
     setup(False, verbose=verbose)
     with tqdm(desc="clone", total=5, disable=_disable) as pbar:
+        source = Path(source).absolute()
         destination = Path(destination)
         if destination.exists():
             raise ClickException(f"Destination `{destination}` may not exist")
-        git_clone(source, destination)
-        pbar.update()
-        dest = Path(destination, ".git", "config")
-        dest.unlink()
-        copy(Path(source, ".git", "config"), dest)
-        pbar.update()
-        darcs_dest = Path(destination, _uuid)
-        repo_source = Path(darcs_dest, "_darcs")
-        darcs_clone(source, darcs_dest)
-        pbar.update()
-        repo_source = Path(darcs_dest, "_darcs")
-        repo_dest = Path(destination, "_darcs")
-        repo_source.rename(repo_dest)
-        rmtree(darcs_dest, ignore_errors=True)
-        pbar.update()
+        # darcs only writes its repo, next to the destination git clones into
+        darcs_dest = Path(destination.parent, f".{destination.name}{_uuid}")
+        try:
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                git = pool.submit(git_clone, source, destination)
+                darcs = pool.submit(darcs_clone, source, darcs_dest, working=False)
+                git.result()
+                pbar.update()
+                darcs.result()
+                pbar.update()
+            dest = Path(destination, ".git", "config")
+            dest.unlink()
+            copy(Path(source, ".git", "config"), dest)
+            pbar.update()
+            adopt_darcs(darcs_dest, destination)
+            pbar.update()
+        finally:
+            rmtree(darcs_dest, ignore_errors=True)
         os.chdir(destination)
-        relink()
+        relink(source)
         pbar.update()
+    copied, linked = get_link_stats(Path(".git"), Path("_darcs"))
+    print(f"{linked} bytes linked, {copied} bytes copied")
 
 
 @main.command()
@@ -941,18 +3514,225 @@ def clone(source, destination, verbose):
     "-l/-nl",
     "--large/--no-large",
     default=False,
-    help="Large repo mode, darcs might miss changes, but import is faster",
+    help="Large repo mode, darcs trusts mtimes, git's changes get fresh ones",
+)
+@click.option(
+    "-t/-nt",
+    "--targeted/--no-targeted",
+    default=False,
+    help="Only record the paths git changed, instead of scanning the whole tree",
 )
-def update(verbose, warn, base, shallow, large):
+@click.option(
+    "-e",
+    "--engine",
+    type=click.Choice(["record", "bundle"]),
+    default="record",
+    help="Record each commit, or write native patches and apply them in bundles",
+)
+@click.option(
+    "--verify/--no-verify",
+    default=False,
+    help="Also compare the file-lists of darcs and git at each checkpoint (bundle)",
+)
+@click.option(
+    "-m",
+    "--maintenance",
+    type=click.Choice(["due", "background", "all", "none"]),
+    default="due",
+    help="Which `darcs optimize` steps to run afterwards, background runs due ones",
+)
+@click.option(
+    "-B",
+    "--branch",
+    "branches",
+    multiple=True,
+    help="Also import branch into a sibling repository (`../<repo>-<branch>`)",
+)
+@click.option(
+    "--strategy",
+    type=click.Choice(["linearize", "first-parent"]),
+    default="linearize",
+    help="Linearize all commits, or one patch per mainline commit (merges too)",
+)
+@click.option(
+    "--squash",
+    "squash_count",
+    type=int,
+    default=0,
+    help="Record windows of up to this many commits as one patch",
+)
+@click.option(
+    "--squash-minutes",
+    type=int,
+    default=0,
+    help="Record windows of commits spanning up to this many minutes as one patch",
+)
+@click.option(
+    "--squash-before",
+    type=click.DateTime(),
+    default=None,
+    help="Only squash commits older than this, without a window one patch",
+)
+def update(
+    verbose,
+    warn,
+    base,
+    shallow,
+    large,
+    targeted,
+    engine,
+    verify,
+    maintenance,
+    branches,
+    strategy,
+    squash_count,
+    squash_minutes,
+    squash_before,
+):
     """Incremental import of git into darcs.
 
     By default it imports a shallow copy (the current commit). Use `--no-shallow`
     to import the complete history.
     """
     global _large
+    global _targeted
+    global _engine
+    global _verify
+    global _maintenance
+    global _strategy
+    global _squash_count
+    global _squash_minutes
+    global _squash_before
     _large = large
+    _targeted = targeted
+    _engine = engine
+    _verify = verify
+    _maintenance = maintenance
+    _strategy = strategy
+    _squash_count = squash_count
+    _squash_minutes = squash_minutes
+    if squash_before:
+        _squash_before = squash_before.timestamp()
     setup(warn, verbose=verbose)
-    run_update(*prepare_update(base, shallow))
+    if branches:
+        update_branches(branches, base, shallow)
+    else:
+        run_update(*prepare_update(base, shallow))
+
+
+@main.command()
+@click.option("-v/-nv", "--verbose/--no-verbose", default=False)
+@click.option(
+    "-w/-nw",
+    "--warn/--no-warn",
+    default=True,
+    help="Warn that repository will be cleared",
+)
+@click.option(
+    "-r",
+    "--ref",
+    default="HEAD",
+    help="The ref to import, whenever it changes",
+)
+@click.option(
+    "-i",
+    "--interval",
+    type=float,
+    default=2.0,
+    help="Seconds between checks, inotify wakes up earlier",
+)
+@click.option(
+    "-l/-nl",
+    "--large/--no-large",
+    default=False,
+    help="Large repo mode, darcs trusts mtimes, git's changes get fresh ones",
+)
+@click.option(
+    "-t/-nt",
+    "--targeted/--no-targeted",
+    default=False,
+    help="Only record the paths git changed, instead of scanning the whole tree",
+)
+@click.option(
+    "-e",
+    "--engine",
+    type=click.Choice(["record", "bundle"]),
+    default="record",
+    help="Record each commit, or write native patches and apply them in bundles",
+)
+@click.option(
+    "-m",
+    "--maintenance",
+    type=click.Choice(["due", "background", "all", "none"]),
+    default="due",
+    help="Which `darcs optimize` steps to run afterwards, background runs due ones",
+)
+def watch(verbose, warn, ref, interval, large, targeted, engine, maintenance):
+    """Keep importing git into darcs, whenever a fetch or commit changes ref.
+
+    Keeps git-sessions and the patch-index open between imports. Stop it with
+    CTRL-D or SIGTERM, it finishes the current patch first.
+    """
+    global _large
+    global _targeted
+    global _engine
+    global _maintenance
+    _large = large
+    _targeted = targeted
+    _engine = engine
+    _maintenance = maintenance
+    setup(warn, verbose=verbose)
+    watch_ref(ref, interval)
+
+
+@main.command()
+@click.option("-v/-nv", "--verbose/--no-verbose", default=False)
+@click.option(
+    "-a/-na",
+    "--all/--no-all",
+    default=False,
+    help="Run all optimize steps, not only the due ones",
+)
+@click.option(
+    "-s/-ns",
+    "--stats/--no-stats",
+    default=False,
+    help="Show the repository statistics and the recorded timings",
+)
+def maintain(verbose, all, stats):
+    """Run the `darcs optimize` steps that are due.
+
+    Timings are recorded in `_darcs`, so the thresholds can be tuned.
+    """
+    setup(False, verbose=verbose)
+    if not Path("_darcs").exists():
+        raise ClickException("Please run git-darcs in the root of your darcs-repo.")
+    if stats:
+        print(get_repo_stats())
+        rows = _index.open().execute(
+            "SELECT step, datetime(started, 'unixepoch'), seconds, patches, pristine "
+            "FROM maintenance ORDER BY rowid"
+        )
+        for step, started, seconds, patches, pristine in rows:
+            print(f"{started} {step:8} {seconds:8.2f}s {patches:8} {pristine:12}")
+        return
+    if all:
+        run_maintenance(list(_maintenance_due))
+    else:
+        run_maintenance(get_due_steps(get_repo_stats()))
+
+
+@main.command()
+@click.argument("name")
+def lookup(name):
+    """Print the darcs-patch of a git-commit, or the git-commit of a darcs-patch."""
+    if not _index_file.exists():
+        raise ClickException("Please run git-darcs in the root of your darcs-repo.")
+    rev = _git.resolve(f"{name}^{{commit}}")
+    res = _index.get_patch(rev) if rev else _index.get_rev(name)
+    if not res:
+        raise ClickException(f"`{name}` is not in the patch-index")
+    print(res)
 
 
 @main.command()
@@ -975,9 +3755,15 @@ def update(verbose, warn, base, shallow, large):
     default=True,
     help="Ignore temporary patches (with 'temp: ')",
 )
+@click.option(
+    "-b/-nb",
+    "--batch/--no-batch",
+    default=False,
+    help="Pull with one `darcs apply` and create the commits with `git fast-import`",
+)
 @click.argument("source", type=click.Path(exists=True, dir_okay=True, file_okay=False))
 @click.argument("darcs", nargs=-1)
-def pull(verbose, all, warn, source, darcs, ignore_temp):
+def pull(verbose, all, warn, source, darcs, ignore_temp, batch):
     """Pull from source darcs-repository into a tracking-repository.
 
     A tracking-repository is created by `git darcs update` and contains a git- and a
@@ -995,4 +3781,4 @@ def pull(verbose, all, warn, source, darcs, ignore_temp):
         )
 
     init()
-    Pull(source, list(darcs), ignore_temp=ignore_temp).pull(all)
+    Pull(source, list(darcs), ignore_temp=ignore_temp).pull(all, batch=batch)
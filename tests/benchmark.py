@@ -0,0 +1,375 @@
+"""Benchmark git-darcs on synthetic histories and the linear fixtures.
+
+Runs `update --no-shallow`, an incremental `update`, `clone` and `pull --all` and
+writes the wall-time and the phase-timings (GIT_DARCS_TIMINGS) as JSON.
+
+    python tests/benchmark.py --shape merges --commits 500 --output merges.json
+"""
+
+import json
+import os
+import platform
+import sys
+import tarfile
+from pathlib import Path
+from random import Random
+from shutil import which
+from subprocess import PIPE, run
+from tempfile import TemporaryDirectory
+from time import monotonic
+
+import click
+
+_root = Path(__file__).absolute().parent.parent
+_tests = Path(__file__).absolute().parent
+_shapes = ["linear", "merges", "renames", "large-tree", "binary", "fixtures"]
+_git_darcs = [sys.executable, "-c", "from git_darcs import main; main()"]
+_env = {
+    "GIT_AUTHOR_NAME": "Bench",
+    "GIT_AUTHOR_EMAIL": "bench@example.com",
+    "GIT_COMMITTER_NAME": "Bench",
+    "GIT_COMMITTER_EMAIL": "bench@example.com",
+    "DARCS_EMAIL": "Bench <bench@example.com>",
+    "PYTHONPATH": str(_root),
+}
+
+
+def env(**kwargs):
+    """Get the environment for benchmarked commands."""
+    res = dict(os.environ)
+    res.update(_env)
+    res.update(kwargs)
+    return res
+
+
+def version(cmd):
+    """Get the version of a tool."""
+    res = run(cmd, stdout=PIPE, env=env())
+    return res.stdout.decode("UTF-8").strip()
+
+
+class History:
+    """Generates a reproducible git-history as `git fast-import` stream."""
+
+    def __init__(self, seed, files, size):
+        """Dear flake8 this is a init function."""
+        self.random = Random(seed)
+        self.size = size
+        self.mark = 0
+        self.date = 1_600_000_000
+        self.tree = {}
+        self.tip = None
+        self.stream = []
+        self.changes = {}
+        for index in range(files):
+            self.write(f"src/dir{index % 50:02d}/file{index:05d}.txt", self.text())
+        self.commit("Initial commit")
+
+    def text(self):
+        """Get a random text-file."""
+        lines = self.random.randint(5, 40)
+        return "".join(f"line {self.random.random()}\n" for _ in range(lines)).encode()
+
+    def write(self, path, data):
+        """Change a file in the next commit."""
+        self.tree[path] = data
+        self.changes[path] = data
+
+    def remove(self, path):
+        """Remove a file in the next commit."""
+        self.tree.pop(path, None)
+        self.changes[path] = None
+
+    def edit(self, count):
+        """Edit count random text-files."""
+        paths = [x for x in self.tree if x.endswith(".txt")]
+        for path in self.random.sample(paths, min(count, len(paths))):
+            lines = self.tree[path].splitlines(keepends=True)
+            pos = self.random.randrange(len(lines) + 1)
+            lines.insert(pos, f"edit {self.random.random()}\n".encode())
+            self.write(path, b"".join(lines))
+
+    def commit(self, message, *, parent=None, merge=None):
+        """Commit the changes, returns the mark of the commit."""
+        self.mark += 1
+        self.date += 60
+        message = message.encode()
+        who = f"Bench <bench@example.com> {self.date} +0000"
+        out = [
+            b"commit refs/heads/main\n",
+            b"mark :%d\n" % self.mark,
+            f"author {who}\ncommitter {who}\n".encode(),
+            b"data %d\n%s\n" % (len(message), message),
+        ]
+        parent = parent or self.tip
+        if parent:
+            out.append(b"from :%d\n" % parent)
+        if merge:
+            out.append(b"merge :%d\n" % merge)
+        for path, data in sorted(self.changes.items()):
+            if data is None:
+                out.append(f"D {path}\n".encode())
+            else:
+                out.append(f"M 100644 inline {path}\n".encode())
+                out.append(b"data %d\n%s\n" % (len(data), data))
+        out.append(b"\n")
+        self.stream += out
+        self.changes = {}
+        self.tip = self.mark
+        return self.mark
+
+    def linear(self, count):
+        """Add commits editing some files, adding and removing a few."""
+        for index in range(count):
+            self.edit(self.random.randint(1, 3))
+            if index % 10 == 0:
+                self.write(f"src/new/file{self.mark:05d}.txt", self.text())
+            if index % 15 == 0:
+                paths = [x for x in self.tree if x.startswith("src/new/")]
+                if paths:
+                    self.remove(self.random.choice(paths))
+            self.commit(f"Linear change {self.mark}")
+
+    def merges(self, count):
+        """Add feature-branches that are merged back, like the linearized history."""
+        done = 0
+        while done < count:
+            base = self.tip
+            tree = dict(self.tree)
+            length = self.random.randint(2, 6)
+            self.linear(length)
+            branch_tip = self.tip
+            branch = {x: y for x, y in self.tree.items() if tree.get(x) != y}
+            removed = [x for x in tree if x not in self.tree]
+            # Meanwhile on main, touch other files than the branch
+            self.tree = tree
+            self.tip = base
+            for path in self.random.sample(sorted(tree), min(2, len(tree))):
+                if path not in branch and path not in removed:
+                    self.write(path, tree[path] + b"main\n")
+            self.commit(f"Main change {self.mark}")
+            for path, data in branch.items():
+                self.write(path, data)
+            for path in removed:
+                self.remove(path)
+            self.commit(f"Merge feature {branch_tip}", merge=branch_tip)
+            done += length + 2
+
+    def renames(self, count):
+        """Add commits moving whole directories and many single files."""
+        for index in range(count):
+            dirs = sorted({x.rsplit("/", 1)[0] for x in self.tree})
+            if index % 2:
+                orig = self.random.choice(dirs)
+                new = f"src/moved{self.mark:05d}"
+                start = len(orig)
+                for path in [x for x in self.tree if x.startswith(f"{orig}/")]:
+                    data = self.tree[path]
+                    self.remove(path)
+                    self.write(new + path[start:], data)
+            else:
+                for path in self.random.sample(
+                    sorted(self.tree), min(20, len(self.tree))
+                ):
+                    data = self.tree[path]
+                    self.remove(path)
+                    self.write(f"{path}.r{self.mark}", data)
+            self.commit(f"Rename storm {self.mark}")
+
+    def binary(self, count):
+        """Add commits changing large binary files."""
+        for index in range(count):
+            path = f"assets/blob{index % 5}.bin"
+            self.write(path, self.random.randbytes(self.size))
+            self.edit(1)
+            self.commit(f"Binary change {self.mark}")
+
+    def generate(self, shape, count):
+        """Generate count commits of shape."""
+        if shape == "merges":
+            self.merges(count)
+        elif shape == "renames":
+            self.renames(count)
+        elif shape == "binary":
+            self.binary(count)
+        else:
+            self.linear(count)
+
+    def flush(self, repo):
+        """Write the generated commits to repo."""
+        marks = Path(repo, ".git", "bench.marks")
+        run(
+            [
+                "git",
+                "fast-import",
+                "--quiet",
+                f"--import-marks-if-exists={marks}",
+                f"--export-marks={marks}",
+            ],
+            input=b"".join(self.stream),
+            cwd=repo,
+            check=True,
+        )
+        run(["git", "reset", "-q", "--hard", "main"], cwd=repo, check=True)
+        self.stream = []
+
+
+class Bench:
+    """Times git-darcs commands and collects their phases."""
+
+    def __init__(self, shape, params):
+        """Dear flake8 this is a init function."""
+        self.shape = shape
+        self.params = params
+        self.results = []
+
+    def time(self, step, args, cwd):
+        """Time a git-darcs command."""
+        timings = Path(cwd).parent / f"{step}.timings.json"
+        start = monotonic()
+        run(
+            _git_darcs + args,
+            cwd=cwd,
+            env=env(GIT_DARCS_TIMINGS=str(timings)),
+            stdout=PIPE,
+            stderr=PIPE,
+            check=True,
+        )
+        seconds = monotonic() - start
+        phases = {}
+        if timings.exists():
+            phases = json.loads(timings.read_text())["phases"]
+        self.results.append(
+            {
+                "shape": self.shape,
+                "params": self.params,
+                "step": step,
+                "seconds": seconds,
+                "phases": phases,
+            }
+        )
+        print(f"{self.shape:10} {step:12} {seconds:10.2f}s", file=sys.stderr)
+
+    def scenario(self, tmp, src, more, options):
+        """Run update, incremental update, clone and pull on src."""
+        track = tmp / "track"
+        run(["git", "clone", "-q", str(src), str(track)], env=env(), check=True)
+        self.time("update-full", ["update", "-nw", "--no-shallow"] + options, track)
+        if more:
+            more(src)
+            run(["git", "pull", "-q", "--ff-only"], cwd=track, env=env(), check=True)
+            self.time("update", ["update", "-nw"] + options, track)
+        work = tmp / "work"
+        self.time("clone", ["clone", str(track), str(work)], tmp)
+        for index in range(10):
+            Path(work, f"pulled{index}.txt").write_text(f"pulled {index}\n")
+            run(["darcs", "add", f"pulled{index}.txt"], cwd=work, env=env(), check=True)
+            run(
+                ["darcs", "record", "-a", "-m", f"Darcs change {index}"],
+                cwd=work,
+                env=env(),
+                stdout=PIPE,
+                check=True,
+            )
+        self.time("pull", ["pull", "-nw", "--all", str(work)], track)
+
+
+def synthetic(bench, shape, commits, incremental, files, size, seed, options):
+    """Benchmark a synthetic history."""
+    with TemporaryDirectory(prefix="git-darcs-bench-") as tmp:
+        tmp = Path(tmp)
+        src = tmp / "src"
+        run(["git", "init", "-q", "-b", "main", str(src)], env=env(), check=True)
+        history = History(seed, files, size)
+        history.generate(shape, commits)
+        history.flush(src)
+
+        def more(src):
+            history.generate(shape, incremental)
+            history.flush(src)
+
+        bench.scenario(tmp, src, more, options)
+
+
+def fixtures(bench, options):
+    """Benchmark the histories in `tests/*.tar.gz`."""
+    for archive in sorted(_tests.glob("linear*.tar.gz")):
+        with TemporaryDirectory(prefix="git-darcs-bench-") as tmp:
+            tmp = Path(tmp)
+            with tarfile.open(archive) as tar:
+                tar.extractall(tmp)
+            name = archive.name.partition(".")[0]
+            bench.params = {"fixture": name}
+            bench.scenario(tmp, tmp / name, None, options)
+
+
+@click.command()
+@click.option(
+    "--shape",
+    "-s",
+    "shapes",
+    type=click.Choice(_shapes),
+    multiple=True,
+    help="History-shapes to benchmark, all if not given",
+)
+@click.option("--commits", "-c", default=200, help="Commits of the first import")
+@click.option(
+    "--incremental", "-i", default=20, help="Commits of the incremental update"
+)
+@click.option("--files", "-f", default=200, help="Files in the initial tree")
+@click.option("--size", default=1 << 20, help="Size of the binary files")
+@click.option("--seed", default=1, help="Seed of the generated histories")
+@click.option(
+    "--output", "-o", type=click.Path(), default=None, help="JSON-file, default stdout"
+)
+@click.argument("options", nargs=-1, metavar="[-- UPDATE-OPTIONS]")
+def main(shapes, commits, incremental, files, size, seed, output, options):
+    """Benchmark git-darcs, arguments after `--` are passed to `update`."""
+    for tool in ("git", "darcs"):
+        if not which(tool):
+            raise click.ClickException(f"`{tool}` is needed for the benchmark")
+    results = []
+    for shape in shapes or _shapes:
+        params = {
+            "commits": commits,
+            "incremental": incremental,
+            "files": files,
+            "size": size,
+            "seed": seed,
+            "options": list(options),
+        }
+        bench = Bench(shape, params)
+        if shape == "fixtures":
+            fixtures(bench, list(options))
+        else:
+            if shape == "large-tree":
+                params["files"] = files * 100
+            synthetic(
+                bench,
+                shape,
+                commits,
+                incremental,
+                params["files"],
+                size,
+                seed,
+                list(options),
+            )
+        results += bench.results
+    report = {
+        "git-darcs": version(
+            ["git", "-C", str(_root), "describe", "--always", "--dirty"]
+        ),
+        "git": version(["git", "--version"]),
+        "darcs": version(["darcs", "--version"]),
+        "python": platform.python_version(),
+        "results": results,
+    }
+    if output:
+        with open(output, "w", encoding="UTF-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()